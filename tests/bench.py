@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Benchmarks for search, random selection, updates and startup. Runs without
+# network access, using the titles / transcripts from search.zip repeated to
+# simulate larger archives, and a local HTTP server standing in for xkcd.com.
+#
+# Usage: bench.py [--scales 1,10,100] [--repeat 3] [--json results.json]
+#                 [--compare baseline.json] [--threshold 1.25]
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import zipfile
+import argparse
+import tempfile
+import threading
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xkcd
+
+search_zip = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "search.zip")
+
+
+def read_zip_lines(name):
+    with zipfile.ZipFile(search_zip) as archive:
+        content = archive.read(name).decode('utf-8')
+    return [x for x in content.split("\n") if x]
+
+
+def write_scaled(path, lines, scale, limit=None):
+    """Write `lines` `scale` times, renumbering each copy after the last.
+    Stops before comic number `limit`. Returns the last comic number."""
+    last = int(lines[-1].split(":")[0])
+    written = 0
+    with open(path, 'w') as out:
+        for copy in range(scale):
+            for line in lines:
+                number, _, value = line.partition(":")
+                number = int(number) + copy * last
+                if limit is not None and number >= limit:
+                    return written
+                out.write("%s:%s\n" % (number, value))
+                written = number
+    return written
+
+
+def best_time(func, repeat, setup=None):
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+class ComicHandler(BaseHTTPRequestHandler):
+    """Serves made-up metadata for any /N/info.0.json."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        match = re.match(r"^/+(\d*)/?info\.0\.json$", self.path)
+        if match is None:
+            body = b"Not found"
+            self.send_response(404)
+        else:
+            number = int(match.group(1) or self.server.max_comic)
+            body = json.dumps({
+                "num": number, "title": "Comic %s" % number,
+                "safe_title": "Comic %s" % number, "alt": "Alt %s" % number,
+                "transcript": "[[A stick figure reads comic %s.]]" % number,
+                "img": "", "year": "2016", "month": "1", "day": "1"
+            }).encode()
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ComicServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), ComicHandler)
+        self.max_comic = 1
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%s" % self.server_address[1]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class Bench(object):
+    """Runs the benchmarks on archives of different scales and collects
+    (benchmark, scale, comics, seconds) results."""
+
+    def __init__(self, workdir, repeat):
+        self.workdir = workdir
+        self.repeat = repeat
+        self.titles = read_zip_lines("titles.txt")
+        self.transcripts = read_zip_lines("transcripts.txt")
+        self.results = []
+
+    def record(self, name, scale, comics, seconds):
+        self.results.append({"benchmark": name, "scale": scale,
+                             "comics": comics, "seconds": seconds})
+        print("%-22s %6s %8s %10.2f %14.3f" % (
+            name, scale, comics, seconds * 1000, seconds * 1e6 / comics))
+
+    def setup_scale(self, scale, limit=None):
+        xkcd.titles_location = os.path.join(self.workdir, "titles.txt")
+        xkcd.transcripts_location = os.path.join(self.workdir,
+                                                 "transcripts.txt")
+        last = write_scaled(xkcd.titles_location, self.titles, scale, limit)
+        write_scaled(xkcd.transcripts_location, self.transcripts, scale,
+                     limit)
+        xkcd.search_index = None
+        return last
+
+    def reset_cache(self):
+        if os.path.exists(xkcd.cache_location):
+            shutil.rmtree(xkcd.cache_location)
+        xkcd.cache_sizes.clear()
+
+    def run_search(self, scale):
+        comics = self.setup_scale(scale)
+        self.reset_cache()
+
+        def build():
+            xkcd.search_index = None
+            xkcd.get_offline_metadata()
+        self.record("search_index_build", scale, comics,
+                    best_time(build, self.repeat))
+        searches = [
+            ("search_titles", xkcd.command_search_titles, ("time",)),
+            ("search_transcripts", xkcd.command_search_transcripts, ("the",)),
+            ("search_all", xkcd.command_search, ("black hat",)),
+            ("search_phrase", xkcd.command_search, ('"stick figure"',)),
+            ("search_fuzzy", xkcd.command_search, ("-f", "raptr")),
+            ("search_fuzzy_hard", xkcd.command_search, ("-f", "compter")),
+            ("search_regex", xkcd.command_search, ("-r", "velocirapt[a-z]+")),
+        ]
+        for name, command, arguments in searches:
+            self.record(name, scale, comics, best_time(
+                lambda: command(*arguments), self.repeat))
+
+    def run_random(self, scale):
+        """Draw 1000 comics."""
+        comics = int(self.titles[-1].split(":")[0]) * scale
+        xkcd.cur_max_comic = comics
+        draws = min(comics - 1, 1000)
+
+        def setup():
+            self.reset_cache()
+            xkcd.load_seen_comics()
+
+        def draw():
+            for _ in range(draws):
+                xkcd.random_unique()
+        self.record("random_unique", scale, comics,
+                    best_time(draw, self.repeat, setup))
+
+    def run_parse_matches(self, scale):
+        comics = int(self.titles[-1].split(":")[0]) * scale
+        matches = [(x, "Comic %s" % x) for x in range(1, comics + 1)]
+        matches += random.sample(matches, comics // 10)  # Duplicates
+        self.record("parse_matches", scale, comics,
+                    best_time(lambda: xkcd.parse_matches(matches),
+                              self.repeat))
+
+    def run_update(self, scale, server):
+        """Download the last 20 * `scale` comics."""
+        comics = int(self.titles[-1].split(":")[0]) * scale
+        missing = 20 * scale
+        server.max_comic = xkcd.cur_max_comic = comics
+
+        def setup():
+            self.setup_scale(scale, limit=comics - missing + 1)
+            self.reset_cache()
+        self.record("update_search_db", scale, comics,
+                    best_time(xkcd.update_search_db, self.repeat, setup))
+
+    def run_startup(self, scale, server):
+        comics = self.setup_scale(scale)
+        server.max_comic = comics
+        titles_location = xkcd.titles_location
+        try:
+            xkcd.offline = True
+            self.record("startup_from_titles", scale, comics,
+                        best_time(xkcd.startup, self.repeat,
+                                  self.reset_cache))
+            xkcd.offline = False
+            xkcd.titles_location = os.path.join(self.workdir, "none.txt")
+            self.record("startup_network", scale, comics,
+                        best_time(xkcd.startup, self.repeat,
+                                  self.reset_cache))
+            xkcd.offline = True
+            self.record("startup_cached", scale, comics,
+                        best_time(xkcd.startup, self.repeat))
+        finally:
+            xkcd.offline = False
+            xkcd.titles_location = titles_location
+
+    def run(self, scales):
+        server = ComicServer()
+        xkcd.api_url = server.url + "/%s/info.0.json"
+        xkcd.cache_location = os.path.join(self.workdir, "cache") + "/"
+        xkcd.mirror_location = os.path.join(self.workdir, "mirror") + "/"
+        xkcd.archive_location = os.path.join(self.workdir, "none.sqlite")
+        xkcd.use_less = False
+        xkcd.prefetch_depth = 0
+        xkcd.update_retry_delay = 0
+        print("%-22s %6s %8s %10s %14s" % ("benchmark", "scale", "comics",
+                                           "ms", "us per comic"))
+        try:
+            for scale in scales:
+                self.run_search(scale)
+                self.run_random(scale)
+                self.run_parse_matches(scale)
+                self.run_update(scale, server)
+                self.run_startup(scale, server)
+        finally:
+            server.close()
+        return self.results
+
+
+def compare(results, baseline, threshold):
+    """Return the results more than `threshold` times slower than in
+    `baseline`."""
+    old = dict(((x["benchmark"], x["scale"]), x["seconds"]) for x in baseline)
+    slower = []
+    for result in results:
+        key = (result["benchmark"], result["scale"])
+        if key in old and result["seconds"] > old[key] * threshold:
+            slower.append((result, old[key]))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark xkcd offline")
+    parser.add_argument("--scales", default="1,10,100",
+                        help="comma-separated archive sizes, in multiples of "
+                             "search.zip (default: 1,10,100)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per benchmark, the best one counts")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results as JSON (- for stdout)")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="fail if slower than the JSON results in FILE")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="how much slower counts as a regression")
+    args = parser.parse_args()
+    scales = [int(x) for x in args.scales.split(",")]
+    workdir = tempfile.mkdtemp()
+    try:
+        results = Bench(workdir, args.repeat).run(scales)
+    finally:
+        shutil.rmtree(workdir)
+    output = json.dumps({"python": sys.version.split()[0],
+                         "results": results}, indent=2, sort_keys=True)
+    if args.json == "-":
+        print(output)
+    elif args.json:
+        with open(args.json, 'w') as out:
+            out.write(output + "\n")
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        slower = compare(results, baseline, args.threshold)
+        for result, old_seconds in slower:
+            print("Regression: %s at scale %s took %.2f ms (was %.2f ms)" % (
+                result["benchmark"], result["scale"],
+                result["seconds"] * 1000, old_seconds * 1000))
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,28 @@ import os
 import sys
 import shutil
 import json
+import io
+import time
+import atexit
+import tempfile
+import threading
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import xkcd
 
+xkcd.cache_location = tempfile.mkdtemp() + "/"
+atexit.register(shutil.rmtree, xkcd.cache_location, True)
+xkcd.prefetch_depth = 0
+xkcd.archive_location = "AAA"
+xkcd.mirror_location = xkcd.cache_location + "mirror/"
+
 comic_1000_transcript = """\
 Explanation
 
@@ -47,6 +64,78 @@ Boy: I wonder where I'll float next?
 {{Alt: Don't we all.}}\
 """
 
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class LocalServer(object):
+    """A stand-in for xkcd.com serving `pages` (path -> (code, body))."""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+        self.clients = set()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                path = "/" + self.path.lstrip("/")
+                server.requests.append(path)
+                server.clients.add(self.client_address)
+                code, body = server.pages.get(path, (404, b"Not found"))
+                headers = {}
+                if callable(body):
+                    code, body, headers = (body(self) + ({},))[:3]
+                self.send_response(code)
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%s" % self.httpd.server_address[1]
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def comic_json(number, transcript="", img=""):
+    return json.dumps({"num": number, "title": "Comic %s" % number,
+                       "transcript": transcript, "alt": "Alt %s" % number,
+                       "img": img, "year": "2016", "month": "1",
+                       "day": "1"}).encode()
+
+
+class LocalServerTestCase(unittest.TestCase):
+    """Runs each test against a LocalServer serving `pages`, with a fresh
+    cache_location. Globals changed with set_global() are restored after the
+    test."""
+    pages = {}
+
+    def setUp(self):
+        self.server = LocalServer(dict(self.pages))
+        self.addCleanup(self.server.close)
+        self.set_global("api_url", self.server.url + "/%s/info.0.json")
+        self.set_global("cache_location", tempfile.mkdtemp() + "/")
+        self.addCleanup(shutil.rmtree, xkcd.cache_location, True)
+        self.set_global("offline", False)
+
+    def set_global(self, name, value):
+        self.addCleanup(setattr, xkcd, name, getattr(xkcd, name))
+        setattr(xkcd, name, value)
+
+
 program_license = """\
 Copyright © 2016 randomdude999
 This program is free software: you can redistribute it and/or modify
@@ -78,11 +167,17 @@ class TestInternetRequiringCommands(unittest.TestCase):
         expected_result = comic_1_transcript
         self.assertEqual(result, expected_result)
 
+    def use_external_renderer(self):
+        self.addCleanup(setattr, xkcd, "explain_renderer",
+                        xkcd.explain_renderer)
+        xkcd.explain_renderer = "external"
+
     @unittest.skipUnless(os.path.exists(xkcd.html_renderer[0]),
                          "Renderer not found")
     def test_command_explain(self):
         xkcd.use_less = False
         xkcd.sel_comic = 1000
+        self.use_external_renderer()
         result = xkcd.command_explain()
         excepted_result = comic_1000_transcript
         self.assertEqual(result, excepted_result)
@@ -91,17 +186,18 @@ class TestInternetRequiringCommands(unittest.TestCase):
                          "Renderer not found")
     def test_command_explain_with_arg(self):
         xkcd.use_less = False
+        self.use_external_renderer()
         result = xkcd.command_explain(1000)
         excepted_result = comic_1000_transcript
         self.assertEqual(result, excepted_result)
 
     def test_command_explain_invalidRenderer(self):
         xkcd.sel_comic = 1
-        renderer = xkcd.html_renderer
+        self.addCleanup(setattr, xkcd, "html_renderer", xkcd.html_renderer)
         xkcd.html_renderer = "this_is_a_fake_command"
+        self.use_external_renderer()
         output = xkcd.command_explain()
         excepted_output = "HTML renderer not found"
-        xkcd.html_renderer = renderer
         self.assertEqual(output, excepted_output)
 
     def test_command_save(self):
@@ -116,7 +212,7 @@ class TestInternetRequiringCommands(unittest.TestCase):
             with open("tests/1000_correct.png", 'rb') as correct_image:
                 correct_content = correct_image.read()
         self.assertEqual(content, correct_content)
-        shutil.rmtree(xkcd.tmpimg_location)
+        shutil.rmtree(xkcd.image_cache_dir())
         os.remove("1000.png")
 
     def test_command_save_404(self):
@@ -348,12 +444,36 @@ class TestCommandRandom(unittest.TestCase):
         xkcd.command_random()
         self.assertEqual(xkcd.sel_comic, 1000)
 
+    def test_random_unique_exhausted(self):
+        xkcd.seen_comics = [1, 2, 3, 1]
+        xkcd.cur_max_comic = 3
+        drawn = set(xkcd.random_unique() for _ in range(3))
+        self.assertEqual(drawn, set([1, 2, 3]))
+        self.assertEqual(sorted(xkcd.seen_comics), [1, 2, 3])
+
+    def test_random_unique_new_comics(self):
+        xkcd.seen_comics = []
+        xkcd.cur_max_comic = 2
+        drawn = [xkcd.random_unique()]
+        xkcd.cur_max_comic = 4
+        drawn += [xkcd.random_unique() for _ in range(3)]
+        self.assertEqual(sorted(drawn), [1, 2, 3, 4])
+
+    def test_random_unique_persistent(self):
+        xkcd.seen_comics = []
+        xkcd.forget_seen_comics()
+        xkcd.cur_max_comic = 10
+        drawn = [xkcd.random_unique() for _ in range(5)]
+        xkcd.load_seen_comics()
+        self.assertEqual(xkcd.seen_comics, drawn)
+
 
 class TestCommandSearch(unittest.TestCase):
 
     def setUp(self):
         xkcd.titles_location = "titles.txt"
         xkcd.transcripts_location = "transcripts.txt"
+        xkcd.use_less = False
 
     def test_command_search(self):
         output = xkcd.command_search("barrel")
@@ -425,6 +545,147 @@ class TestCommandSearch(unittest.TestCase):
         xkcd.titles_location = old_titles
         self.assertEqual(output, excepted_output)
 
+    def test_command_search_ranked(self):
+        output = xkcd.command_search("barrel").split("\n")
+        self.assertEqual(output[1], "(#1) Barrel - Part 1")
+        titles = [x for x in output if "Barrel - Part" in x]
+        self.assertEqual(output[1:6], titles)
+
+    def test_command_search_and(self):
+        output = xkcd.command_search("git", "commit")
+        self.assertEqual(output, "Matches:\n(#1296) Git Commit\n")
+
+    def test_command_search_or(self):
+        output = xkcd.command_search_titles("Git", "Commit", "OR", "Barrel")
+        self.assertIn("(#1296) Git Commit", output)
+        self.assertIn("(#1) Barrel - Part 1", output)
+
+    def test_command_search_phrase(self):
+        output = xkcd.command_search_titles('"part', '1"')
+        self.assertIn("(#1) Barrel - Part 1", output)
+        self.assertNotIn("Barrel - Part 2", output)
+
+    def test_command_search_transcripts_identical(self):
+        xkcd.titles_location = "test.txt"
+        xkcd.transcripts_location = "test2.txt"
+        with open("test.txt", 'w') as fd:
+            fd.write("1:'First'\n2:'Second'\n3:'Third'\n")
+        with open("test2.txt", 'w') as fd:
+            fd.write("1:'Same text'\n2:'Other'\n3:'Same text'\n")
+        output = xkcd.command_search_transcripts("same")
+        os.remove("test.txt")
+        os.remove("test2.txt")
+        self.assertEqual(output, "Matches:\n(#1) First\n(#3) Third\n")
+
+    def test_transcripts_memory_mapped(self):
+        index = xkcd.get_offline_metadata()
+        self.assertIsInstance(index.transcripts, xkcd.MappedStore)
+        self.assertIn("asdf", index.transcripts.get(1296))
+        self.assertTrue(index.transcripts.contains(1296, "a commit log"))
+        self.assertFalse(index.transcripts.contains(1, "git commit"))
+        self.assertEqual(index.transcripts.get(404), "")
+
+    def test_transcript_store_rebuilt(self):
+        xkcd.titles_location = "test.txt"
+        xkcd.transcripts_location = "test2.txt"
+        with open("test.txt", 'w') as fd:
+            fd.write("1:'A'\n2:'B'\n")
+        with open("test2.txt", 'w') as fd:
+            fd.write("1:'Caf\\xe9'\n")
+        self.assertEqual(xkcd.get_offline_metadata().transcripts.get(1),
+                         u"Caf\xe9")
+        with open("test2.txt", 'a') as fd:
+            fd.write("2:'Second'\n")
+        store = xkcd.get_offline_metadata().transcripts
+        os.remove("test.txt")
+        os.remove("test2.txt")
+        self.assertEqual((len(store), store.get(2)), (2, "Second"))
+
+    def test_transcript_store_per_file(self):
+        xkcd.titles_location = "test.txt"
+        for name, text in (("test2.txt", u"Caf\xe9"),
+                           ("test3.txt", u"Tea!!")):
+            with io.open(name, 'w', encoding='utf-8') as fd:
+                fd.write(u"1:'%s'\n" % text)
+            os.utime(name, (1000, 1000))  # Same mtime and size
+        with open("test.txt", 'w') as fd:
+            fd.write("1:'A'\n")
+        try:
+            xkcd.transcripts_location = "test2.txt"
+            first = xkcd.get_offline_metadata().transcripts.get(1)
+            xkcd.transcripts_location = "test3.txt"
+            second = xkcd.get_offline_metadata().transcripts.get(1)
+        finally:
+            for name in ("test.txt", "test2.txt", "test3.txt"):
+                os.remove(name)
+        self.assertEqual((first, second), (u"Caf\xe9", u"Tea!!"))
+
+    def test_command_search_fuzzy(self):
+        output = xkcd.command_search_titles("-f", "barel")
+        self.assertIn("(#1) Barrel - Part 1", output)
+        self.assertEqual(xkcd.command_search_titles("barel"), "Matches:\n")
+
+    def test_command_search_fuzzy_distance(self):
+        output = xkcd.command_search_titles("--fuzzy", "git", "comitt")
+        self.assertEqual(output, "Matches:\n(#1296) Git Commit\n")
+        self.assertEqual(xkcd.edit_distance("commit", "comitt", 2), 2)
+        self.assertEqual(xkcd.edit_distance("commit", "git", 1), 2)
+        self.assertEqual(xkcd.bag_distance("commit", "comitt"), 1)
+
+    def test_command_search_regex(self):
+        output = xkcd.command_search_transcripts("-r", "asd[f]")
+        self.assertEqual(output, "Matches:\n(#1296) Git Commit\n")
+        output = xkcd.command_search_titles("-r", "^barrel - part [12]$")
+        self.assertEqual(output, "Matches:\n(#1) Barrel - Part 1\n"
+                                 "(#11) Barrel - Part 2\n")
+
+    def test_search_regex_same_for_both_stores(self):
+        xkcd.titles_location = "test.txt"
+        xkcd.transcripts_location = "test2.txt"
+        with io.open("test.txt", 'w', encoding='utf-8') as fd:
+            fd.write(u"1:'\xc9clair'\n2:'An \xc9clair'\n")
+        with io.open("test2.txt", 'w', encoding='utf-8') as fd:
+            fd.write(u"1:'\xc9clair'\n2:'An \xc9clair'\n")
+        try:
+            index = xkcd.get_offline_metadata()
+            self.assertIsInstance(index.transcripts, xkcd.MappedStore)
+            titles = xkcd.find_comics(u"^\xe9clair", ("title",), "regex")
+            transcripts = xkcd.find_comics(u"^\xe9clair", ("transcript",),
+                                           "regex")
+        finally:
+            os.remove("test.txt")
+            os.remove("test2.txt")
+        self.assertEqual(titles, [(1, u"\xc9clair")])
+        self.assertEqual(transcripts, titles)
+
+    def test_command_search_invalid_regex(self):
+        output = xkcd.command_search("-r", "(")
+        self.assertTrue(output.startswith("Invalid regular expression"))
+
+    def test_command_search_mode_noargs(self):
+        self.assertEqual(xkcd.command_search("-r"), "Missing argument: query")
+
+    def test_search_index_reused(self):
+        first = xkcd.get_offline_metadata()
+        xkcd.command_search("barrel")
+        self.assertIs(xkcd.get_offline_metadata(), first)
+        self.assertEqual(first.titles[1], "Barrel - Part 1")
+
+    def test_search_index_reloaded_on_change(self):
+        xkcd.titles_location = "test.txt"
+        xkcd.transcripts_location = "test2.txt"
+        with open("test.txt", 'w') as fd:
+            fd.write("1:'Test'\n")
+        with open("test2.txt", 'w') as fd:
+            fd.write("1:''\n")
+        self.assertEqual(xkcd.command_search_titles("tester"), "Matches:\n")
+        with open("test.txt", 'a') as fd:
+            fd.write("2:'Tester'\n")
+        output = xkcd.command_search_titles("tester")
+        os.remove("test.txt")
+        os.remove("test2.txt")
+        self.assertEqual(output, "Matches:\n(#2) Tester\n")
+
     def test_update_search_db(self):
         xkcd.cur_max_comic = 1
         xkcd.command_update()
@@ -450,6 +711,875 @@ class TestCommandSearch(unittest.TestCase):
         self.assertEqual(output, expected_output)
 
 
+@unittest.skipIf(xkcd.sqlite3 is None, "sqlite3 not available")
+class TestArchive(LocalServerTestCase):
+    pages = dict(("/%s/info.0.json" % x, (200, comic_json(x, "Text %s" % x)))
+                 for x in range(1, 4))
+
+    def setUp(self):
+        super(TestArchive, self).setUp()
+        self.set_global("archive_location",
+                        xkcd.cache_location + "archive.sqlite")
+        self.set_global("update_retry_delay", 0)
+        self.set_global("use_less", False)
+        search_zip = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), "search.zip")
+        xkcd.command_import(search_zip)
+
+    def test_search(self):
+        output = xkcd.command_search_transcripts("asdf")
+        self.assertEqual(output, "Matches:\n(#1296) Git Commit\n")
+
+    def test_search_titles(self):
+        self.set_global("titles_location", "AAA")
+        output = xkcd.command_search_titles("barrel")
+        self.assertEqual(len(output.splitlines()), 6)
+        self.assertIn("(#31) Barrel - Part 5", output)
+
+    def test_failed_import_leaves_no_archive(self):
+        self.set_global("archive_location",
+                        xkcd.cache_location + "new.sqlite")
+        bad_zip = xkcd.cache_location + "bad.zip"
+        with open(bad_zip, 'wb') as fd:
+            fd.write(b"not a zip")
+        output = xkcd.command_import(bad_zip)
+        self.assertTrue(output.startswith("Could not import"))
+        self.assertFalse(os.path.exists(xkcd.archive_location))
+
+    def test_update_and_display(self):
+        with xkcd.get_archive() as db:
+            db.execute("DELETE FROM comics WHERE num > 1")
+        xkcd.cur_max_comic = 3
+        output = xkcd.update_search_db()
+        self.assertEqual(output, "3 comics without full metadata in "
+                                 "archive found.")
+        self.assertEqual(xkcd.command_search("alt", "3"),
+                         "Matches:\n(#3) Comic 3\n")
+        requests = len(self.server.requests)
+        self.assertIn("Text 2", xkcd.display_text(2))
+        self.assertEqual(len(self.server.requests), requests)
+
+    def test_update_adds_only_new_comics(self):
+        self.set_global("update_search_db_with_comics", True)
+        with xkcd.get_archive() as db:
+            db.execute("DELETE FROM comics WHERE num > 1")
+        self.server.pages["/info.0.json"] = (200, comic_json(3))
+        xkcd.cur_max_comic = 1
+        output = xkcd.command_update()
+        self.assertEqual(output, "2 new comics!\n2 comics not in archive "
+                                 "found.")
+        self.assertNotIn("/1/info.0.json", self.server.requests)
+        self.assertIsNotNone(xkcd.get_archived_metadata(3))
+
+
+class TestUpdateSearchDb(LocalServerTestCase):
+    pages = dict(("/%s/info.0.json" % x, (200, comic_json(x)))
+                 for x in range(1, 6))
+
+    def setUp(self):
+        super(TestUpdateSearchDb, self).setUp()
+        self.set_global("titles_location", "test.txt")
+        self.set_global("transcripts_location", "test2.txt")
+        self.set_global("update_retry_delay", 0)
+        xkcd.cur_max_comic = 5
+
+    def tearDown(self):
+        if xkcd.search_index is not None:
+            xkcd.search_index.close()
+            xkcd.search_index = None
+        os.remove("test.txt")
+        os.remove("test2.txt")
+
+    def read_numbers(self, path):
+        with open(path) as fd:
+            return [int(x.split(":")[0]) for x in fd.read().splitlines()]
+
+    def test_update_search_db_resume(self):
+        with open("test.txt", 'w') as fd:
+            fd.write("1:'Comic 1'\n2:'Comic 2'\n3:'Com")
+        with open("test2.txt", 'w') as fd:
+            fd.write("1:''\n")
+        output = xkcd.update_search_db()
+        self.assertEqual(output, "4 comics not in title database found.")
+        self.assertEqual(self.read_numbers("test.txt"), [1, 2, 3, 4, 5])
+        self.assertEqual(self.read_numbers("test2.txt"), [1, 2, 3, 4, 5])
+        self.assertNotIn("/1/info.0.json", self.server.requests)
+        self.assertEqual(xkcd.get_offline_metadata().titles[3], "Comic 3")
+
+    def test_update_search_db_retry(self):
+        failures = []
+
+        def flaky(handler):
+            if not failures:
+                failures.append(True)
+                return 503, b"Try again"
+            return 200, comic_json(2)
+        self.server.pages["/2/info.0.json"] = (200, flaky)
+        with open("test.txt", 'w') as fd:
+            fd.write("1:'Comic 1'\n")
+        with open("test2.txt", 'w') as fd:
+            fd.write("1:''\n")
+        xkcd.update_search_db()
+        self.assertEqual(self.read_numbers("test.txt"), [1, 2, 3, 4, 5])
+
+    def write_files(self, last):
+        with open("test.txt", 'w') as fd:
+            fd.write("".join("%s:'Comic %s'\n" % (x, x)
+                             for x in range(1, last + 1)))
+        with open("test2.txt", 'w') as fd:
+            fd.write("".join("%s:'Text %s'\n" % (x, x)
+                             for x in range(1, last + 1)))
+
+    def test_update_merges_into_index(self):
+        self.server.pages["/4/info.0.json"] = \
+            (200, comic_json(4, transcript="New text"))
+        self.write_files(2)
+        index = xkcd.get_offline_metadata()
+        self.assertIsInstance(index.transcripts, xkcd.MappedStore)
+        xkcd.update_search_db()
+        self.assertIs(xkcd.get_offline_metadata(), index)
+        self.assertEqual(xkcd.find_comics("new", ("transcript",)),
+                         [(4, "Comic 4")])
+        self.assertEqual(index.transcripts.get(4), "New text")
+        self.assertEqual(xkcd.find_comics("comic [4]", ("title",), "regex"),
+                         [(4, "Comic 4")])
+        self.assertEqual(xkcd.find_comics("neew", ("transcript",), "fuzzy"),
+                         [(4, "Comic 4")])
+        rebuilt = xkcd.SearchIndex(
+            xkcd.read_metadata_file("test.txt"),
+            xkcd.MemoryStore(xkcd.read_metadata_file("test2.txt")),
+            index.stamp)
+        for attribute in ("postings", "lengths", "avg_length", "terms",
+                          "trigrams"):
+            self.assertEqual(getattr(index, attribute),
+                             getattr(rebuilt, attribute))
+        stat = os.stat("test2.txt")
+        self.assertEqual(index.transcripts.source,
+                         (stat.st_mtime, stat.st_size))
+
+    def test_search_during_update(self):
+        self.set_global("update_workers", 1)
+        seen = []
+
+        def search(handler):
+            seen.append(xkcd.get_offline_metadata())
+            return 200, comic_json(4)
+        self.server.pages["/4/info.0.json"] = (200, search)
+        self.write_files(2)
+        xkcd.cur_max_comic = 4
+        index = xkcd.get_offline_metadata()
+        xkcd.update_search_db()
+        self.assertIs(seen[0], index)  # Comic 3 was written by then
+        self.assertIs(xkcd.get_offline_metadata(), index)
+        self.assertEqual(index.titles[4], "Comic 4")
+
+    def test_update_adds_comics_to_search_db(self):
+        self.set_global("update_search_db_with_comics", True)
+        self.server.pages["/info.0.json"] = (200, comic_json(5))
+        xkcd.cur_max_comic = 3
+        self.write_files(3)
+        output = xkcd.command_update()
+        self.assertEqual(output, "2 new comics!\n2 comics not in title "
+                                 "database found.")
+        self.assertEqual(self.read_numbers("test.txt"), [1, 2, 3, 4, 5])
+
+    def test_update_leaves_search_db_by_default(self):
+        self.server.pages["/info.0.json"] = (200, comic_json(5))
+        xkcd.cur_max_comic = 3
+        self.write_files(3)
+        self.assertEqual(xkcd.command_update(), "2 new comics!\n")
+        self.assertEqual(self.read_numbers("test.txt"), [1, 2, 3])
+
+    def test_update_search_db_error(self):
+        self.set_global("update_search_db_with_comics", True)
+        self.server.pages["/info.0.json"] = (200, comic_json(5))
+        xkcd.cur_max_comic = 3
+        self.write_files(3)
+        self.set_global("titles_location", xkcd.cache_location)  # Not a file
+        output = xkcd.command_update()
+        self.assertTrue(output.startswith("2 new comics!\nCouldn't update "
+                                          "the search database: "), output)
+        self.assertEqual(xkcd.cur_max_comic, 5)
+
+    def test_update_search_db_failure(self):
+        self.server.pages["/4/info.0.json"] = (500, b"Error")
+        with open("test.txt", 'w') as fd:
+            fd.write("1:'Comic 1'\n")
+        with open("test2.txt", 'w') as fd:
+            fd.write("1:''\n")
+        output = xkcd.update_search_db()
+        self.assertIn("Failed to download comic 4", output)
+        self.assertEqual(self.read_numbers("test.txt"), [1, 2, 3])
+        self.assertEqual(self.read_numbers("test2.txt"), [1, 2, 3])
+
+
+class TestMetadataCache(LocalServerTestCase):
+    pages = {"/1/info.0.json": (200, comic_json(1))}
+
+    def setUp(self):
+        super(TestMetadataCache, self).setUp()
+        self.set_global("use_less", False)
+
+    def test_display_cached(self):
+        first = xkcd.display_text(1)
+        second = xkcd.display_text(1)
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.requests, ["/1/info.0.json"])
+
+    def test_latest_revalidated(self):
+        def latest(handler):
+            if handler.headers.get("If-None-Match") == '"v1"':
+                return 304, b"", {"ETag": '"v1"'}
+            return 200, comic_json(2), {"ETag": '"v1"'}
+        self.server.pages["/info.0.json"] = (200, latest)
+        first = xkcd.get_metadata("")
+        second = xkcd.get_metadata("")
+        self.assertEqual(first, (comic_json(2), 200))
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_recent_comic_revalidated(self):
+        transcripts = []
+
+        def comic_2(handler):
+            if handler.headers.get("If-None-Match") == '"v1"':
+                return 304, b"", {"ETag": '"v1"'}
+            transcripts.append("Text")
+            return 200, comic_json(2, "Text"), {"ETag": '"v1"'}
+        self.server.pages["/2/info.0.json"] = (200, comic_2)
+        self.set_global("metadata_recent_comics", 1)
+        xkcd.store_metadata("latest.json", comic_json(2))
+        xkcd.store_metadata("2.json", comic_json(2))  # No transcript yet
+        self.assertEqual(xkcd.get_metadata(2)[0], comic_json(2, "Text"))
+        self.assertEqual(xkcd.get_metadata(2)[0], comic_json(2, "Text"))
+        self.assertEqual(len(transcripts), 1)
+        xkcd.get_metadata(1)
+        xkcd.get_metadata(1)
+        self.assertEqual(self.server.requests.count("/1/info.0.json"), 1)
+        xkcd.offline = True
+        self.assertEqual(xkcd.get_metadata(2)[0], comic_json(2, "Text"))
+
+    def test_eviction(self):
+        self.set_global("metadata_cache_max_bytes", 100)
+        for x in range(5):
+            xkcd.store_metadata("%s.json" % x, b"x" * 40)
+            os.utime(os.path.join(xkcd.metadata_cache_dir(), "%s.json" % x),
+                     (x, x))
+        remaining = sorted(os.listdir(xkcd.metadata_cache_dir()))
+        self.assertEqual(remaining, ["4.json"])
+
+
+class TestStartup(LocalServerTestCase):
+    pages = {"/info.0.json": (200, comic_json(20))}
+
+    def setUp(self):
+        super(TestStartup, self).setUp()
+        self.set_global("titles_location", "AAA")
+
+    def test_startup_uses_cache(self):
+        xkcd.store_metadata("latest.json", comic_json(10))
+        xkcd.offline = True
+        xkcd.startup()
+        self.assertEqual((xkcd.cur_max_comic, xkcd.sel_comic), (10, 10))
+        self.assertEqual(self.server.requests, [])
+
+    def test_startup_no_cache(self):
+        xkcd.startup()
+        self.assertEqual((xkcd.cur_max_comic, xkcd.sel_comic), (20, 20))
+
+    def test_startup_refreshes_before_batch(self):
+        xkcd.store_metadata("latest.json", comic_json(10))
+        xkcd.startup(background=False)
+        self.assertEqual((xkcd.cur_max_comic, xkcd.sel_comic), (20, 20))
+
+    def test_refresh_max_comic(self):
+        xkcd.cur_max_comic = xkcd.sel_comic = 10
+        xkcd.refresh_max_comic()
+        self.assertEqual((xkcd.cur_max_comic, xkcd.sel_comic), (20, 20))
+
+    def test_offline(self):
+        xkcd.offline = True
+        self.assertRaises(xkcd.urllib.URLError, xkcd.get_metadata, 1)
+        self.assertEqual(self.server.requests, [])
+
+
+class TestPrefetch(LocalServerTestCase):
+
+    def setUp(self):
+        super(TestPrefetch, self).setUp()
+        for x in range(1, 10):
+            img = self.server.url + "/img/%s.png" % x
+            self.server.pages["/%s/info.0.json" % x] = \
+                (200, comic_json(x, img=img))
+            self.server.pages["/img/%s.png" % x] = \
+                (200, ("PNG %s" % x).encode())
+        self.set_global("prefetch_depth", 2)
+        self.set_global("prefetch_max_rate", 0)
+        xkcd.cur_max_comic = 9
+
+    def test_prefetch_next(self):
+        xkcd.sel_comic = 3
+        xkcd.command_next()
+        xkcd.prefetch_queue.join()
+        self.assertEqual(sorted(os.listdir(xkcd.image_cache_dir())),
+                         ["5.png", "6.png"])
+        self.assertIn("/5/info.0.json", self.server.requests)
+        self.assertNotIn("/4/info.0.json", self.server.requests)
+
+    def test_prefetch_prev(self):
+        xkcd.sel_comic = 3
+        xkcd.command_prev()
+        xkcd.prefetch_queue.join()
+        self.assertEqual(os.listdir(xkcd.image_cache_dir()), ["1.png"])
+        with open(xkcd.image_path(1), 'rb') as fd:
+            self.assertEqual(fd.read(), b"PNG 1")
+
+
+class TestImageCache(LocalServerTestCase):
+
+    def setUp(self):
+        super(TestImageCache, self).setUp()
+        for x in range(1, 4):
+            img = self.server.url + "/img/%s.png" % x
+            self.server.pages["/%s/info.0.json" % x] = \
+                (200, comic_json(x, img=img))
+            self.server.pages["/img/%s.png" % x] = (200, b"x" * 40)
+
+    def test_cached_across_calls(self):
+        xkcd.cache_img_if_not_exist(2)
+        xkcd.cache_img_if_not_exist(2)
+        self.assertEqual(self.server.requests.count("/img/2.png"), 1)
+        self.assertEqual(os.listdir(xkcd.image_cache_dir()), ["2.png"])
+
+    def test_server_error(self):
+        xkcd.cache_img_if_not_exist(1)
+        self.server.pages["/img/2.png"] = (500, b"x" * 40)
+        output = xkcd.cache_img_if_not_exist(2)
+        self.assertEqual(output, "Couldn't download the image (response "
+                                 "code: 500)")
+        self.assertEqual(os.listdir(xkcd.image_cache_dir()), ["1.png"])
+        self.assertEqual(xkcd.cache_sizes[xkcd.image_cache_dir()], 40)
+
+    def test_eviction(self):
+        self.set_global("image_cache_max_bytes", 100)
+        for x in range(1, 3):
+            xkcd.cache_img_if_not_exist(x)
+            os.utime(xkcd.image_path(x), (x, x))
+        xkcd.cache_img_if_not_exist(3)
+        self.assertEqual(os.listdir(xkcd.image_cache_dir()), ["3.png"])
+
+
+class TestDisplayBackends(LocalServerTestCase):
+
+    def setUp(self):
+        super(TestDisplayBackends, self).setUp()
+        for x in range(1, 3):
+            img = self.server.url + "/img/%s.png" % x
+            self.server.pages["/%s/info.0.json" % x] = \
+                (200, comic_json(x, img=img))
+            self.server.pages["/img/%s.png" % x] = \
+                (200, ("PNG %s" % x).encode())
+        self.server.pages["/3/info.0.json"] = (200, comic_json(3))
+        self.set_global("display_backend", "command")
+
+    def tearDown(self):
+        if xkcd.viewer_process is not None:
+            xkcd.viewer_process.kill()
+            xkcd.viewer_process.wait()
+            xkcd.viewer_process = None
+
+    @unittest.skipUnless(os.name == "posix", "Needs a POSIX shell")
+    def test_command(self):
+        copy = os.path.join(xkcd.cache_location, "copy.png")
+        self.set_global("display_cmd", "cp %s " + copy)
+        self.assertEqual(xkcd.display_img(1), "")
+        xkcd.display_processes[-1].wait()
+        with open(copy, 'rb') as fd:
+            self.assertEqual(fd.read(), b"PNG 1")
+
+    @unittest.skipUnless(os.name == "posix", "Needs a POSIX shell")
+    def test_viewer_reused(self):
+        xkcd.display_backend = "viewer"
+        self.set_global("viewer_cmd", "exec sleep 30 # %s")
+        xkcd.display_img(1)
+        viewer = xkcd.viewer_process
+        xkcd.display_img(2)
+        self.assertIs(xkcd.viewer_process, viewer)
+        with open(os.path.join(xkcd.cache_location, "viewer.png"), 'rb') as fd:
+            self.assertEqual(fd.read(), b"PNG 2")
+
+    def test_no_image(self):
+        self.assertEqual(xkcd.display_img(3), "No image for comic found "
+                                              "(maybe it's interactive?)")
+
+    @unittest.skipIf(xkcd.Image is None, "PIL not installed")
+    def test_terminal(self):
+        image = xkcd.Image.new("RGB", (2, 2), (255, 0, 0))
+        image.putpixel((0, 1), (0, 0, 255))
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        self.server.pages["/img/1.png"] = (200, buffer.getvalue())
+        xkcd.display_backend = "terminal"
+        output = xkcd.display_img(1)
+        self.assertEqual(output.count(u"\u2580"), 2)
+        self.assertIn("\x1b[38;2;255;0;0m\x1b[48;2;0;0;255m", output)
+        self.assertEqual(xkcd.display_img(1), output)
+        self.assertEqual(self.server.requests.count("/img/1.png"), 1)
+
+    @unittest.skipIf(xkcd.Image is None, "PIL not installed")
+    def test_terminal_transparency(self):
+        buffer = io.BytesIO()
+        xkcd.Image.new("RGBA", (2, 2), (0, 0, 0, 0)).save(buffer, "PNG")
+        self.server.pages["/img/1.png"] = (200, buffer.getvalue())
+        xkcd.display_backend = "terminal"
+        output = xkcd.display_img(1)
+        self.assertIn("\x1b[38;2;255;255;255m\x1b[48;2;255;255;255m", output)
+
+    @unittest.skipUnless(xkcd.Image is None, "PIL installed")
+    def test_terminal_no_pil(self):
+        xkcd.display_backend = "terminal"
+        self.assertIn("pillow", xkcd.display_img(1))
+
+
+def png(size, colour):
+    content = io.BytesIO()
+    xkcd.Image.new("RGB", size, colour).save(content, "PNG")
+    return content.getvalue()
+
+
+@unittest.skipIf(xkcd.Image is None, "PIL not installed")
+class TestThumbnails(LocalServerTestCase):
+
+    def setUp(self):
+        super(TestThumbnails, self).setUp()
+        for x in range(1, 4):
+            img = self.server.url + "/img/%s.png" % min(x, 2)
+            self.server.pages["/%s/info.0.json" % x] = \
+                (200, comic_json(x, img=img))
+        self.server.pages["/img/1.png"] = (200, png((400, 200), (255, 0, 0)))
+        self.server.pages["/img/2.png"] = (200, png((100, 300), (0, 0, 255)))
+        xkcd.cur_max_comic = xkcd.sel_comic = 3
+
+    def test_thumbnail_keyed_by_content(self):
+        xkcd.cache_img_if_not_exist(2)
+        xkcd.cache_img_if_not_exist(3)  # Same image as comic 2
+        first = xkcd.get_thumbnail(xkcd.image_path(2), 50, 50)
+        second = xkcd.get_thumbnail(xkcd.image_path(3), 50, 50)
+        self.assertEqual(first, second)
+        self.assertEqual(xkcd.Image.open(first).size, (17, 50))
+        other_size = xkcd.get_thumbnail(xkcd.image_path(2), 20, 20)
+        self.assertNotEqual(other_size, first)
+        self.assertEqual(len(os.listdir(xkcd.thumbnail_cache_dir())), 2)
+
+    @unittest.skipUnless(os.name == "posix", "Needs a POSIX shell")
+    def test_gallery(self):
+        copy = os.path.join(xkcd.cache_location, "copy.png")
+        self.set_global("display_cmd", "cp %s " + copy)
+        self.set_global("gallery_thumbnail_size", (40, 40))
+        self.assertEqual(xkcd.command_gallery("1", "3"), "")
+        xkcd.display_processes[-1].wait()
+        sheet = xkcd.Image.open(copy)
+        self.assertEqual(sheet.size, (3 * 50, 65))
+        self.assertEqual(sheet.getpixel((25, 20)), (255, 0, 0))
+        self.assertEqual(sheet.getpixel((75, 20)), (0, 0, 255))
+
+    def test_contact_sheet_transparency(self):
+        path = os.path.join(xkcd.cache_location, "clear.png")
+        xkcd.Image.new("RGBA", (40, 40), (0, 0, 0, 0)).save(path)
+        self.set_global("gallery_thumbnail_size", (40, 40))
+        sheet = xkcd.Image.open(io.BytesIO(
+            xkcd.make_contact_sheet([(1, path)])))
+        self.assertEqual(sheet.getpixel((25, 20)), (255, 255, 255))
+
+    def test_gallery_no_images(self):
+        self.server.pages["/img/1.png"] = (404, b"")
+        self.assertEqual(xkcd.command_gallery("1", "1"), "No images to show")
+
+
+class TestMirror(LocalServerTestCase):
+
+    def setUp(self):
+        super(TestMirror, self).setUp()
+        for x in range(1, 4):
+            img = self.server.url + "/img/%s.png" % (x % 2)
+            self.server.pages["/%s/info.0.json" % x] = \
+                (200, comic_json(x, img=img))
+        self.server.pages["/img/1.png"] = (200, b"PNG 1")
+        self.server.pages["/img/0.png"] = (200, b"PNG 0")
+        self.set_global("mirror_location", xkcd.cache_location + "mirror/")
+        xkcd.cur_max_comic = 3
+
+    def test_mirror(self):
+        output = xkcd.command_mirror()
+        self.assertEqual(output, "Mirrored 3 comics, 0 were already "
+                                 "mirrored, 0 failed.")
+        objects = []
+        for _, _, files in os.walk(xkcd.mirror_location + "objects"):
+            objects += files
+        self.assertEqual(len(objects), 2)
+        output = xkcd.command_mirror("2")
+        self.assertEqual(output, "Mirrored 0 comics, 2 were already "
+                                 "mirrored, 0 failed.")
+
+    def test_mirror_offline_use(self):
+        xkcd.command_mirror()
+        xkcd.offline = True
+        self.set_global("use_less", False)
+        self.assertIn("Comic 3", xkcd.display_text(3))
+        with open(xkcd.image_path(3), 'rb') as fd:
+            self.assertEqual(fd.read(), b"PNG 1")
+        self.assertEqual(xkcd.get_cached_max_comic(), 3)
+
+    def test_mirror_left_untouched(self):
+        xkcd.command_mirror()
+        xkcd.offline = True
+        path = xkcd.mirrored_image_path(3)
+        os.utime(path, (1, 1))
+        self.assertEqual(xkcd.cache_img_if_not_exist(3), "")
+        self.assertEqual(os.stat(path).st_mtime, 1)
+
+    def test_save_download_error(self):
+        self.server.pages["/img/1.png"] = (500, b"Error")
+        xkcd.sel_comic = 3
+        location = xkcd.cache_location + "saved.png"
+        output = xkcd.command_save(location)
+        self.assertEqual(output, "Couldn't download the image (response "
+                                 "code: 500)")
+        self.assertFalse(os.path.exists(location))
+
+    def test_mirror_failure(self):
+        del self.server.pages["/img/1.png"]
+        self.server.pages["/2/info.0.json"] = (500, b"Error")
+        self.set_global("update_retry_delay", 0)
+        output = xkcd.command_mirror()
+        self.assertIn("1 failed.\ncomic 2: response code 500", output)
+        self.assertTrue(xkcd.is_mirrored(3))
+        self.assertIsNone(xkcd.mirrored_image_path(3))
+
+
+explain_page = b"""\
+<html><head><script>var x = "<p>";</script></head><body>
+<div id="toc" class="toc">Contents</div>
+<h2><span class="mw-headline" id="Explanation">Explanation</span>\
+<span class="mw-editsection">[<a href="/edit">edit</a>]</span></h2>
+<p>A long   paragraph about <a href="/wiki/Cueball">Cueball</a>,
+split over lines.<sup class="reference">[1]</sup></p>
+<ul><li>First point</li><li>Second &amp; last point</li></ul>
+<h3><span class="mw-headline">Details</span></h3>
+<p>More \xc3\xa9xplanation.</p>
+<h2><span class="mw-headline" id="Transcript">Transcript</span></h2>
+<dl><dd>Cueball: Hi.</dd><dd>Megan: Hello.</dd></dl>
+<h2><span class="mw-headline" id="Discussion">Discussion</span></h2>
+<p>Comments</p>
+</body></html>"""
+
+explain_text = u"""\
+Explanation
+
+A long paragraph about Cueball, split over lines.
+
+  * First point
+  * Second & last point
+
+Details
+
+More \xe9xplanation.
+
+Transcript
+
+Cueball: Hi.
+Megan: Hello.
+"""
+
+
+class TestExplain(LocalServerTestCase):
+    pages = {"/1": (200, explain_page)}
+
+    def setUp(self):
+        super(TestExplain, self).setUp()
+        self.set_global("explainxkcd_url", self.server.url + "/%s")
+        self.set_global("explain_renderer", "builtin")
+        self.set_global("use_less", False)
+
+    def test_extract_sections(self):
+        parser = xkcd.ExplanationParser(("Explanation", "Transcript"))
+        for x in range(0, len(explain_page), 7):  # Split inside tags and é
+            parser.write(explain_page[x:x + 7])
+        self.assertEqual(parser.get_text(), explain_text)
+
+    def test_explain_cached(self):
+        self.assertEqual(xkcd.command_explain(1), explain_text)
+        self.assertEqual(xkcd.command_explain(1), explain_text)
+        self.assertEqual(self.server.requests, ["/1"])
+
+    def test_explain_expired(self):
+        xkcd.command_explain(1)
+        self.set_global("explain_cache_ttl", 0)
+        xkcd.command_explain(1)
+        self.assertEqual(len(self.server.requests), 2)
+        xkcd.offline = True
+        self.assertEqual(xkcd.command_explain(1), explain_text)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_explain_renderer_not_found(self):
+        self.set_global("explain_renderer", "external")
+        self.set_global("html_renderer", "this_is_a_fake_command")
+        self.assertEqual(xkcd.command_explain(1), "HTML renderer not found")
+
+    def test_explain_argument_is_number(self):
+        xkcd.sel_comic = 1
+        self.assertEqual(xkcd.command_explain("../1"), explain_text)
+        self.assertEqual(os.listdir(xkcd.explain_cache_dir()),
+                         ["1-builtin.txt"])
+
+    def test_explain_not_found(self):
+        output = xkcd.command_explain(2)
+        self.assertEqual(output, "Something might've gone wrong (response "
+                                 "code: 404)")
+
+
+class TestExport(LocalServerTestCase):
+    pages = dict(("/%s/info.0.json" % x,
+                  (200, comic_json(x, transcript=u"a, \"b\"\n\xe7")))
+                 for x in range(1, 4))
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        xkcd.cur_max_comic = 3
+
+    def read_export(self, name):
+        with io.open(os.path.join(xkcd.cache_location, name),
+                     encoding='utf-8', newline="") as fd:
+            return fd.read()
+
+    def test_export_jsonl(self):
+        location = os.path.join(xkcd.cache_location, "out.jsonl")
+        output = xkcd.command_export("2", location)
+        self.assertEqual(output, "Exported 2 comics to %s." % location)
+        lines = self.read_export("out.jsonl").splitlines()
+        self.assertEqual([json.loads(x)["num"] for x in lines], [2, 3])
+
+    def test_export_csv(self):
+        location = os.path.join(xkcd.cache_location, "out.csv")
+        xkcd.command_export("1", "1", location)
+        content = self.read_export("out.csv")
+        self.assertTrue(content.startswith(",".join(xkcd.export_fields)))
+        self.assertIn(u"\n1,Comic 1,,", content)
+        self.assertIn(u'"a, ""b""\n\xe7"', content)
+
+    def test_export_offline_uses_cache(self):
+        xkcd.get_metadata(1)
+        xkcd.offline = True
+        location = os.path.join(xkcd.cache_location, "out.jsonl")
+        output = xkcd.command_export("--jsonl", location)
+        self.assertIn("Exported 1 comics", output)
+        self.assertIn("2 failed", output)
+        self.assertEqual(len(self.read_export("out.jsonl").splitlines()), 1)
+
+    def test_export_in_job(self):
+        self.addCleanup(setattr, sys, "stdout", sys.stdout)
+        self.addCleanup(xkcd.jobs.clear)
+        sys.stdout = io.StringIO()
+        xkcd.parse_input("export 2 &")
+        output = xkcd.wait_for_jobs().splitlines()
+        self.assertEqual(sys.stdout.getvalue(), "")
+        self.assertEqual(output[0], "[1] Done: export 2")
+        self.assertEqual([json.loads(x)["num"] for x in output[1:]], [2, 3])
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalServer({
+            "/a": (200, b"A"),
+            "/b": (200, b"B"),
+            "/big": (200, b"x" * 1000),
+            "/moved": (200, lambda handler: (301, b"", {"Location": "/a"}))
+        })
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_connection_reused(self):
+        self.assertEqual(xkcd.get_url(self.server.url + "/a"), b"A")
+        self.assertEqual(xkcd.get_url(self.server.url + "/b"), b"B")
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_redirect(self):
+        output = xkcd.get_url(self.server.url + "/moved", True)
+        self.assertEqual(output, (b"A", 200))
+
+    def test_not_found(self):
+        output = xkcd.get_url(self.server.url + "/c", True)
+        self.assertEqual(output, (b"Not found", 404))
+
+    def test_download_file(self):
+        old_chunk_size = xkcd.download_chunk_size
+        xkcd.download_chunk_size = 300
+        progress = []
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "big.png")
+        try:
+            output = xkcd.download_file(self.server.url + "/big", path,
+                                        lambda *x: progress.append(x))
+            with open(path, 'rb') as fd:
+                content = fd.read()
+        finally:
+            xkcd.download_chunk_size = old_chunk_size
+            shutil.rmtree(directory)
+        self.assertEqual(output, (1000, 200))
+        self.assertEqual(content, b"x" * 1000)
+        self.assertEqual(progress, [(300, 1000), (600, 1000), (900, 1000),
+                                    (1000, 1000)])
+        self.assertEqual(xkcd.get_url(self.server.url + "/a"), b"A")
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_http_proxy(self):
+        # The handler prefixes a "/", so an absolute-URI request lands here
+        self.server.pages["/http://example.invalid/a"] = (200, b"proxied")
+        old_environ = dict(os.environ)
+        self.addCleanup(os.environ.update, old_environ)
+        self.addCleanup(os.environ.clear)
+        for name in ("no_proxy", "NO_PROXY", "HTTP_PROXY"):
+            os.environ.pop(name, None)
+        os.environ["http_proxy"] = self.server.url
+        output = xkcd.get_url("http://example.invalid/a")
+        self.assertEqual(output, b"proxied")
+
+    def test_download_file_not_found(self):
+        directory = tempfile.mkdtemp()
+        try:
+            output = xkcd.download_file(self.server.url + "/c",
+                                        os.path.join(directory, "c.png"))
+            self.assertEqual(output[1], 404)
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestBatchMode(unittest.TestCase):
+
+    class Output(object):
+        def __init__(self):
+            self.writes = []
+
+        def write(self, text):
+            self.writes.append(text)
+
+        def flush(self):
+            pass
+
+    def setUp(self):
+        self.old_stdout = sys.stdout
+        sys.stdout = self.Output()
+        xkcd.cur_max_comic = 2000
+        xkcd.isrunning = True
+
+    def tearDown(self):
+        sys.stdout = self.old_stdout
+
+    def test_run_batch(self):
+        output = sys.stdout
+        xkcd.run_batch(["# comment", "goto 100; nosuchcommand", "",
+                        "license"])
+        self.assertEqual(xkcd.sel_comic, 100)
+        self.assertEqual(output.writes, ["Unknown command\n",
+                                         program_license + "\n"])
+
+    def test_run_batch_exit(self):
+        output = sys.stdout
+        xkcd.run_batch(["exit; nosuchcommand", "nosuchcommand"])
+        self.assertEqual(output.writes, [])
+        self.assertFalse(xkcd.isrunning)
+
+    def test_write_outputs(self):
+        output = sys.stdout
+        xkcd.write_outputs(iter(["\n"]))
+        self.assertEqual(output.writes, [])
+        xkcd.write_outputs(iter(["\n", "a\n"]))
+        self.assertEqual(output.writes, ["\na\n"])
+
+    def test_run_commands_lazy(self):
+        outputs = xkcd.run_commands("goto 5; goto 6")
+        next(outputs)
+        self.assertEqual(xkcd.sel_comic, 5)
+        next(outputs)
+        self.assertEqual(xkcd.sel_comic, 6)
+
+
+class TestPager(unittest.TestCase):
+
+    def setUp(self):
+        self.old_less_cmd = xkcd.less_cmd
+        self.directory = tempfile.mkdtemp()
+        self.paged = os.path.join(self.directory, "paged.txt")
+        xkcd.use_less = True
+
+    def tearDown(self):
+        xkcd.less_cmd = self.old_less_cmd
+        xkcd.use_less = False
+        shutil.rmtree(self.directory)
+
+    def test_stream_to_pager(self):
+        xkcd.less_cmd = (sys.executable, "-c", "import sys; open(%r, 'w')."
+                         "write(sys.stdin.read())" % self.paged)
+        output = xkcd.print_long_text("%s\n" % x for x in range(1000))
+        self.assertEqual(output, "")
+        with open(self.paged) as fd:
+            self.assertEqual(fd.read().split(), [str(x) for x in range(1000)])
+
+    def test_pager_closed_early(self):
+        xkcd.less_cmd = (sys.executable, "-c", "import sys; sys.stdin.read(1)")
+        produced = []
+
+        def lines():
+            for x in range(100000):
+                produced.append(x)
+                yield "x" * 100 + "\n"
+        self.assertEqual(xkcd.print_long_text(lines()), "")
+        self.assertLess(len(produced), 100000)
+
+    def test_no_pager(self):
+        xkcd.use_less = False
+        self.assertEqual(xkcd.print_long_text(iter(["a", "b"])), "ab")
+
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        xkcd.cur_max_comic = 2000
+        self.started = threading.Event()
+
+        def slow(*arguments):
+            self.started.set()
+            while True:
+                xkcd.check_cancelled()
+                time.sleep(0.01)
+        xkcd.commands["slow"] = slow
+
+    def tearDown(self):
+        del xkcd.commands["slow"]
+        xkcd.jobs.clear()
+
+    def test_background_command(self):
+        output = xkcd.parse_input("goto 5 &")
+        self.assertEqual(output, "[1] goto 5\n")
+        self.assertEqual(xkcd.wait_for_jobs(), "[1] Done: goto 5\n")
+        self.assertEqual(xkcd.sel_comic, 5)
+        self.assertEqual(xkcd.jobs, {})
+
+    def test_cancel(self):
+        xkcd.parse_input("slow&")
+        self.started.wait()
+        self.assertEqual(xkcd.command_jobs(), "[1] Running: slow")
+        self.assertEqual(xkcd.command_cancel("1"), "Cancelling [1] slow")
+        self.assertEqual(xkcd.wait_for_jobs(), "[1] Done: slow\ncancelled")
+
+    def test_cancel_no_job(self):
+        self.assertEqual(xkcd.command_cancel(), "No jobs")
+        self.assertEqual(xkcd.command_cancel("3"), "No such job")
+
+
 class TestMiscFunctions(unittest.TestCase):
 
     def test_func_parse_input(self):
@@ -513,6 +1643,14 @@ class TestMiscFunctions(unittest.TestCase):
         expected_output = 1
         self.assertEqual(output, expected_output)
 
+    def test_decode_metadata_line(self):
+        output = xkcd.decode_metadata_line("1296:'Git Commit'\n")
+        self.assertEqual(output, (1296, "Git Commit"))
+
+    def test_decode_metadata_line_not_literal(self):
+        self.assertRaises(ValueError, xkcd.decode_metadata_line,
+                          "1:__import__('os').getcwd()\n")
+
     def test_less_missing(self):
         xkcd.use_less = True
         xkcd.less_cmd = "thisisafakecmd"
@@ -31,15 +31,54 @@ import os
 import sys
 import shutil
 from subprocess import Popen, PIPE
-import random  # those are standard
+import random
+import ast
+import re
+import math
+import bisect
+import time
+import socket
+import threading
+import tempfile
+import argparse
+import zipfile
+import struct
+import mmap
+import hashlib
+import csv
+import io
+import codecs
+import base64
+import textwrap  # those are standard
 if sys.version_info[0] < 3:
     import urllib2 as urllib
+    import httplib
+    from urlparse import urlsplit, urljoin
+    from Queue import Queue
+    from StringIO import StringIO
+    from HTMLParser import HTMLParser
+    from htmlentitydefs import name2codepoint
+    chr = unichr
 else:
     import urllib.request as urllib
+    import http.client as httplib
+    from urllib.parse import urlsplit, urljoin
+    from queue import Queue
+    from io import StringIO
+    from html.parser import HTMLParser
+    from html.entities import name2codepoint
 try:
     import simplejson as json
 except ImportError:
     import json
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
 try:
     import readline
 except ImportError:
@@ -62,13 +101,57 @@ version = "v0.3.2"
 prompt = "xkcd [%s]> "  # the %s is current comic number
 title = "xkcd [%s]"  # Title shown in command prompt
 icon_name = "xkcd"  # Shown in taskbar
+# How images are shown: "command" (display_cmd), "viewer" (one window that
+# is reused, using viewer_cmd) or "terminal" (needs PIL)
+display_backend = "command"
 display_cmd = "display %s"  # command used to display images, %s is file path
+viewer_cmd = "display -update 1 %s"  # Viewer that reloads %s when it changes
+display_max_size = None  # (width, height) to shrink images to (needs PIL)
+gallery_size = 12  # Comics shown by `gallery' without arguments
+gallery_columns = 4
+gallery_thumbnail_size = (200, 200)
+# How `explain' renders pages: "builtin", or "external" to use html_renderer
+explain_renderer = "builtin"
 html_renderer = ("/usr/bin/w3m", "-dump", "-T", "text/html", "-O", "utf-8")
-tmpimg_location = "/tmp/xkcd/"  # remember trailing (back)slash
+explain_sections = ("Explanation", "Transcript")  # Shown by builtin renderer
+explain_cache_ttl = 24 * 60 * 60  # Seconds before explanations are refreshed
 save_location = os.getenv("HOME") + "/Pictures/"  # Default save location
 titles_location = "/usr/share/xkcd/titles.txt"  # Location to store titles
 transcripts_location = "/usr/share/xkcd/transcripts.txt"  # ^ for transcripts
+# SQLite archive, used instead of the title / transcript files if it exists
+archive_location = "/usr/share/xkcd/archive.sqlite"
 less_cmd = "/bin/less"  # If using linux, where to find 'less'
+offline = False  # Never use the network (also set by --offline)
+http_pool_size = 4  # Idle connections kept open per server
+http_timeout = 30  # Seconds to wait for a server before giving up
+cache_location = os.getenv("HOME") + "/.cache/xkcd/"  # remember trailing slash
+metadata_cache_max_bytes = 16 * 1024 * 1024  # Size limit of cached metadata
+# How many of the newest comics are revalidated like the latest one (their
+# transcripts are usually added some time after they're released)
+metadata_recent_comics = 10
+image_cache_max_bytes = 256 * 1024 * 1024  # Size limit of cached images
+# Full offline copy of all comics, made with the `mirror' command
+mirror_location = os.getenv("HOME") + "/.local/share/xkcd/mirror/"
+mirror_workers = 8  # How many comics to download at once when mirroring
+prefetch_depth = 3  # Comics to download ahead when using next / prev
+prefetch_images = True  # Whether to also download images ahead
+prefetch_max_rate = 256 * 1024  # Bytes per second used for prefetching
+download_chunk_size = 64 * 1024  # Bytes read at a time when downloading images
+
+# Search database updates
+
+update_workers = 8  # How many comics to download at once
+update_retries = 3  # Attempts per comic before giving up
+update_retry_delay = 1.0  # Seconds before the first retry, doubled each time
+# Also add new comics to the search database when `update' finds them (only
+# if it's writable)
+update_search_db_with_comics = False
+
+# Search ranking (BM25)
+
+search_title_weight = 3.0  # How much more a word in a title counts
+bm25_k1 = 1.2  # Term frequency saturation
+bm25_b = 0.75  # Document length normalization
 
 # URLs
 
@@ -81,118 +164,1315 @@ explainxkcd_url = "http://www.explainxkcd.com/%s"  # Explain xkcd url
 #  #############################
 
 def print_long_text(text):
-    if use_less:
+    """Show `text` in the pager, or return it if the pager isn't used.
+
+    `text` can also be an iterable of strings, which are sent to the pager as
+    they are produced, so the first screen is shown without waiting for the
+    rest.
+    """
+    if isinstance(text, (type(""), type(u""))):
+        text = [text]
+    if use_less and current_job() is None:
         try:
             proc = Popen(less_cmd, stdin=PIPE)
         except OSError:
-            return text
-        out = proc.communicate(text.encode())[0]
-        return out if out is not None else ""
+            return "".join(text)
+        try:
+            for chunk in text:
+                proc.stdin.write(chunk.encode('utf-8'))
+                proc.stdin.flush()
+        except (IOError, OSError):
+            pass  # The pager was closed before everything was shown
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        proc.wait()
+        return ""
     else:
-        return text
+        return "".join(text)
+
+
+http_pools = {}
+http_pools_lock = threading.Lock()
+
+
+def get_proxy(scheme, host):
+    """Return (host:port, request headers) of the proxy set for `scheme` in
+    the environment (http_proxy, https_proxy, no_proxy), or None."""
+    proxy = urllib.getproxies().get(scheme)
+    if not proxy or urllib.proxy_bypass(host):
+        return None
+    parts = urlsplit(proxy if "://" in proxy else "http://" + proxy)
+    headers = {}
+    if parts.username is not None:
+        credentials = "%s:%s" % (parts.username, parts.password or "")
+        headers["Proxy-Authorization"] = "Basic " + base64.b64encode(
+            credentials.encode('utf-8')).decode('ascii')
+    return "%s:%s" % (parts.hostname, parts.port or 80), headers
+
+
+def get_connection(scheme, netloc, proxy=None):
+    """Return an idle connection to `netloc`, or a new one. With a `proxy`
+    (from get_proxy()), https is tunneled through it and http is sent to
+    it."""
+    with http_pools_lock:
+        pool = http_pools.get((scheme, netloc))
+        if pool:
+            return pool.pop()
+    if proxy is None:
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=http_timeout)
+        return httplib.HTTPConnection(netloc, timeout=http_timeout)
+    proxy_netloc, proxy_headers = proxy
+    if scheme == "https":
+        connection = httplib.HTTPSConnection(proxy_netloc,
+                                             timeout=http_timeout)
+        parts = urlsplit("//" + netloc)
+        connection.set_tunnel(parts.hostname, parts.port or 443,
+                              proxy_headers)
+        return connection
+    return httplib.HTTPConnection(proxy_netloc, timeout=http_timeout)
+
+
+def release_connection(scheme, netloc, connection):
+    with http_pools_lock:
+        pool = http_pools.setdefault((scheme, netloc), [])
+        if len(pool) < http_pool_size:
+            pool.append(connection)
+            return
+    connection.close()
+
+
+def read_response(response, output, progress):
+    """Read a response's body. If `output` is given, copy it there in chunks
+    instead and return an empty string."""
+    if output is None:
+        return response.read()
+    total = response.getheader("Content-Length")
+    total = int(total) if total and total.isdigit() else None
+    done = 0
+    while True:
+        check_cancelled()
+        chunk = response.read(download_chunk_size)
+        if not chunk:
+            break
+        output.write(chunk)
+        done += len(chunk)
+        if progress is not None:
+            progress(done, total)
+    return b""
+
+
+def get_url_(url, request_headers, output=None, progress=None):
+    """Do a GET request, following redirects and reusing open connections.
+
+    Returns (content, response code, response headers). Network errors are
+    raised as URLError. If `output` (a file) is given, the body of a 200
+    response is streamed to it and `progress(bytes done, total bytes or None)`
+    is called after each chunk.
+    """
+    if offline:
+        raise urllib.URLError("offline mode, %s is not available" % url)
+    for _ in range(10):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError("unknown url type: %r" % url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = request_headers
+        proxy = get_proxy(parts.scheme, parts.hostname)
+        if proxy is not None and parts.scheme == "http":
+            path = "http://%s%s" % (parts.netloc, path)  # The proxy needs it
+            headers = dict(request_headers, **proxy[1])
+        for attempt in range(2):
+            connection = get_connection(parts.scheme, parts.netloc, proxy)
+            reused = connection.sock is not None
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error) as err:
+                connection.close()
+                if reused and attempt == 0:
+                    continue  # Server closed the idle connection, try again
+                raise urllib.URLError(err)
+            break
+        try:
+            content = read_response(
+                response, output if response.status == 200 else None,
+                progress)
+        except (httplib.HTTPException, socket.error) as err:
+            connection.close()
+            raise urllib.URLError(err)
+        if response.will_close:
+            connection.close()
+        else:
+            release_connection(parts.scheme, parts.netloc, connection)
+        location = response.getheader("Location")
+        if response.status in (301, 302, 303, 307, 308) and location:
+            url = urljoin(url, location)
+            continue
+        return content, response.status, response.msg
+    raise urllib.URLError("Too many redirects")
 
 
-def get_url_(req):
-    try:
-        response = urllib.urlopen(req)
-    except urllib.HTTPError as err:
-        content = err.read()
-        response_code = err.getcode()
-    else:
-        content = response.read()
-        response_code = response.getcode()
-        response.close()
-    return content, response_code
+def fetch_url(url, request_headers=None, output=None, progress=None):
+    headers = {"User-Agent": "xkcd/%s (by randomdude999 <just.so.you.can."
+                             "email.me@gmail.com>)" % version}
+    headers.update(request_headers or {})
+    return get_url_(url, headers, output, progress)
 
 
 def get_url(url, return_status_code=False):
-    req = urllib.Request(url)
-    req.add_header("User-Agent", "xkcd/%s (by randomdude999 <just.so.you.can."
-                                 "email.me@gmail.com>)" % version)
-    content, response_code = get_url_(req)
+    content, response_code, _ = fetch_url(url)
     if return_status_code:
         return content, response_code
     else:
         return content
 
 
-def get_img(num):
-    data = get_url(api_url % num)
+def call_with_retries(func, *args):
+    """Call func(*args), which returns (content, response code), retrying on
+    network and server errors."""
+    delay = update_retry_delay
+    for attempt in range(update_retries):
+        last_try = attempt == update_retries - 1
+        try:
+            content, response_code = func(*args)
+        except (urllib.URLError, socket.error):
+            if last_try or offline:
+                raise
+        else:
+            if response_code < 500 or last_try:
+                return content, response_code
+        time.sleep(delay)
+        delay *= 2
+
+
+def replace_file(source, destination):
+    try:
+        os.replace(source, destination)
+    except AttributeError:  # Python 2
+        if os.name == "nt" and os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+def make_dirs(directory):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:  # Created by another thread in the meantime
+            pass
+
+
+def write_file_atomic(path, content):
+    """Write `content` to a temporary file, then rename it to `path`."""
+    directory = os.path.dirname(path)
+    make_dirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(content)
+        replace_file(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def download_file(url, path, progress=None):
+    """Stream `url` into a temporary file, then rename it to `path`.
+
+    Only a 200 response creates `path`. Returns (bytes written, response code).
+    """
+    directory = os.path.dirname(path)
+    make_dirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            response_code = fetch_url(url, output=tmp_file,
+                                      progress=progress)[1]
+            size = tmp_file.tell()
+        if response_code == 200:
+            replace_file(tmp_path, path)
+        else:
+            os.remove(tmp_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return size, response_code
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(download_chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_file(path):
+    with open(path, 'rb') as cached_file:
+        return cached_file.read()
+
+
+cache_sizes = {}
+cache_sizes_lock = threading.Lock()
+
+
+def metadata_cache_dir():
+    return os.path.join(cache_location, "json")
+
+
+def image_cache_dir():
+    return os.path.join(cache_location, "img")
+
+
+def store_in_cache(directory, name, content, max_bytes):
+    """Store a file in a cache directory, evicting least recently used files
+    if the directory grows over `max_bytes`."""
+    write_file_atomic(os.path.join(directory, name), content)
+    account_cache_file(directory, len(content), max_bytes)
+
+
+def account_cache_file(directory, size, max_bytes):
+    """Record that `size` bytes were added to a cache directory."""
+    with cache_sizes_lock:
+        if directory not in cache_sizes:
+            cache_sizes[directory] = sum(
+                os.path.getsize(os.path.join(directory, x))
+                for x in os.listdir(directory))
+        else:
+            cache_sizes[directory] += size
+        if cache_sizes[directory] > max_bytes:
+            cache_sizes[directory] = evict_lru(directory, max_bytes // 2)
+
+
+def store_metadata(name, content):
+    store_in_cache(metadata_cache_dir(), name, content,
+                   metadata_cache_max_bytes)
+
+
+def touch_cache_file(path):
+    """Mark a cached file as recently used. Returns False if it's gone."""
+    try:
+        os.utime(path, None)
+    except OSError:
+        return False
+    return True
+
+
+def evict_lru(directory, max_bytes):
+    """Delete the least recently used files of `directory` until it's at most
+    `max_bytes` big. Returns the new size."""
+    entries = []
+    for name in os.listdir(directory):
+        if name.startswith(".tmp"):
+            continue  # Still being written
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(entry[1] for entry in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+    return total
+
+
+def is_recent_comic(comic):
+    """Whether `comic` is one of the metadata_recent_comics newest comics,
+    according to the cached latest comic."""
+    try:
+        path = os.path.join(metadata_cache_dir(), "latest.json")
+        latest = json.loads(read_file(path).decode('utf-8'))['num']
+    except (IOError, OSError, ValueError, KeyError):
+        return False
+    return comic > latest - metadata_recent_comics
+
+
+def get_metadata(comic):
+    """Return (content, response code) of a comic's info.0.json.
+
+    Older comics never change, so once downloaded they are served from the
+    metadata cache. The latest comic ('') and the few newest ones are
+    revalidated with the server using ETag / Last-Modified; when that isn't
+    possible, a cached copy of a recent comic is still used.
+    """
+    comic = str(comic)
+    if not comic.isdigit() and comic != "":
+        return get_url(api_url % comic, True)
+    if comic:
+        archived = get_archived_metadata(comic)
+        if archived is not None:
+            return archived, 200
+        mirrored = os.path.join(mirror_location, "json", "%s.json" % comic)
+        if os.path.exists(mirrored):
+            return read_file(mirrored), 200
+    name = comic or "latest"
+    path = os.path.join(metadata_cache_dir(), "%s.json" % name)
+    recent = comic != "" and is_recent_comic(int(comic))
+    if comic and not recent and touch_cache_file(path):
+        try:
+            return read_file(path), 200
+        except (IOError, OSError):  # Evicted in the meantime
+            pass
+    request_headers = {}
+    validators_path = os.path.join(metadata_cache_dir(), "%s.headers" % name)
+    if os.path.exists(path) and os.path.exists(validators_path):
+        validators = json.loads(read_file(validators_path).decode('utf-8'))
+        if validators.get("etag"):
+            request_headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            request_headers["If-Modified-Since"] = validators["last_modified"]
+    try:
+        content, response_code, headers = fetch_url(api_url % comic,
+                                                    request_headers)
+    except urllib.URLError:
+        if recent and os.path.exists(path):
+            return read_file(path), 200
+        raise
+    if response_code == 304:
+        return read_file(path), 200
+    if response_code == 200:
+        store_metadata("%s.json" % name, content)
+        if not comic or recent:
+            validators = {"etag": headers.get("ETag"),
+                          "last_modified": headers.get("Last-Modified")}
+            store_metadata("%s.headers" % name,
+                           json.dumps(validators).encode())
+    return content, response_code
+
+
+def map_concurrently(func, items, workers):
+    """Yield (item, func(item)) for `items`, in order, using worker threads.
+
+    At most 2 * `workers` items are queued or held at a time, so results are
+    produced lazily. An exception raised by `func` is re-raised here.
+    """
+    tasks = Queue()
+    results = {}
+    done = threading.Condition()
+    stopped = []
+
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None or stopped:
+                return
+            index, item = task
+            try:
+                result = (True, func(item))
+            except Exception as err:
+                result = (False, err)
+            with done:
+                results[index] = result
+                done.notify_all()
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    pending = []
+    items = iter(items)
+    next_index = 0
+    try:
+        while True:
+            while len(pending) < workers * 2:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                tasks.put((next_index + len(pending), item))
+                pending.append(item)
+            if not pending:
+                return
+            with done:
+                while next_index not in results:
+                    done.wait()
+                success, result = results.pop(next_index)
+            item = pending.pop(0)
+            next_index += 1
+            if not success:
+                raise result
+            check_cancelled()
+            yield item, result
+    finally:
+        stopped.append(True)
+        for _ in threads:
+            tasks.put(None)
+
+
+def get_img(num, progress=None):
+    data = get_metadata(num)[0]
     try:
         comic_data = json.loads(data.decode('utf-8'))
         img_source = comic_data['img']
     except (KeyError, ValueError):
         return "Something went wrong when decoding JSON\nraw text:\n%s" % data
-    result = get_url(img_source, True)
-    if result[1] == 404:
+    if not img_source:
         return "No image for comic found (maybe it's interactive?)"
-    else:
-        img_data = result[0]
-        if not os.path.isdir(tmpimg_location):
-            os.mkdir(tmpimg_location)
-        fd = open(tmpimg_location + "%s.png" % sel_comic, 'wb')
-        fd.write(img_data)
-        fd.close()
-        return True
+    size, response_code = download_file(
+        img_source, os.path.join(image_cache_dir(), "%s.png" % num), progress)
+    if response_code == 404:
+        return "No image for comic found (maybe it's interactive?)"
+    elif response_code != 200:
+        return "Couldn't download the image (response code: %s)" % \
+            response_code
+    account_cache_file(image_cache_dir(), size, image_cache_max_bytes)
+    return True
+
+
+def image_path(comic):
+    mirrored = mirrored_image_path(comic)
+    if mirrored is not None:
+        return mirrored
+    return os.path.join(image_cache_dir(), "%s.png" % comic)
+
+
+class SearchIndex(object):
+    """Offline titles and transcripts, keyed by comic number.
+
+    Loaded once and shared by all search commands; `get_offline_metadata()`
+    reloads it when the files on disk change. Holds an inverted index per
+    field (term -> {comic number: term frequency}) used for ranked search.
+    The text itself is kept in a MemoryStore or MappedStore per field, which
+    is used for matching quoted phrases.
+    """
+
+    def __init__(self, titles, transcripts, stamp):
+        self.titles = titles
+        self.transcripts = transcripts
+        self.stamp = stamp
+        self.fields = {"title": MemoryStore(titles),
+                       "transcript": transcripts}
+        self.postings = {}
+        self.lengths = {}
+        self.avg_length = {}
+        self.terms = {}
+        self.trigrams = {}
+        for field, store in self.fields.items():
+            self.postings[field], self.lengths[field] = \
+                build_postings(store.items_lower())
+            total = sum(self.lengths[field].values())
+            self.avg_length[field] = \
+                float(total) / len(store) if len(store) else 0.0
+            self.terms[field] = sorted(self.postings[field])
+            self.trigrams[field] = build_trigrams(self.terms[field])
+
+    def close(self):
+        self.transcripts.close()
+
+    def update(self, new_texts, stamp, transcripts_source=None):
+        """Merge new comics into the index without rebuilding it.
+
+        `new_texts` maps a field to a list of (comic number, text). Texts of
+        comics already in the index replace the old ones. `stamp` is the
+        stamp of the files / archive the index matches afterwards.
+        """
+        for field, items in new_texts.items():
+            if not items:
+                continue
+            store = self.fields[field]
+            postings = self.postings[field]
+            lengths = self.lengths[field]
+            for number, _ in items:
+                if number in lengths:  # Forget the old text
+                    for token in set(tokenize(store.get(number))):
+                        postings[token].pop(number, None)
+            if field == "transcript":
+                store.add(items, transcripts_source)
+            else:
+                store.add(items)
+            new_postings, new_lengths = build_postings(
+                (number, text.lower()) for number, text in items)
+            for term, posting in new_postings.items():
+                if term not in postings:
+                    postings[term] = {}
+                    bisect.insort(self.terms[field], term)
+                    add_trigrams(self.trigrams[field], term)
+                postings[term].update(posting)
+            lengths.update(new_lengths)
+            self.avg_length[field] = \
+                float(sum(lengths.values())) / len(store)
+        self.stamp = stamp
+
+    def expand_term(self, field, prefix):
+        """Return all indexed terms of `field` starting with `prefix`."""
+        terms = self.terms[field]
+        pos = bisect.bisect_left(terms, prefix)
+        expanded = []
+        while pos < len(terms) and terms[pos].startswith(prefix):
+            expanded.append(terms[pos])
+            pos += 1
+        return expanded
+
+    def fuzzy_expand_term(self, field, term):
+        """Return (indexed term, similarity) for all terms of `field` within
+        a small edit distance of `term`, or starting with it."""
+        max_distance = fuzzy_max_distance(term)
+        term_trigrams = get_trigrams(term)
+        # Every edit changes at most 3 trigrams, so a match within
+        # max_distance shares at least this many with the query term. It
+        # can't be more than max_distance characters longer or shorter.
+        min_shared = max(1, len(term_trigrams) - 3 * max_distance)
+        lengths = range(len(term) - max_distance,
+                        len(term) + max_distance + 1)
+        shared = {}
+        for trigram in term_trigrams:
+            by_length = self.trigrams[field].get(trigram)
+            if by_length is None:
+                continue
+            for length in lengths:
+                for candidate in by_length.get(length, ()):
+                    shared[candidate] = shared.get(candidate, 0) + 1
+        expanded = dict((x, 1.0) for x in self.expand_term(field, term))
+        for candidate, count in shared.items():
+            if count < min_shared or candidate in expanded or \
+                    bag_distance(term, candidate) > max_distance:
+                continue
+            distance = edit_distance(term, candidate, max_distance)
+            if distance <= max_distance:
+                expanded[candidate] = 1.0 / (1 + distance)
+        return expanded.items()
+
+    def term_scores(self, term, fields, fuzzy=False):
+        """BM25 scores of all comics matching the query term `term`."""
+        weighted_tfs = {}
+        for field in fields:
+            weight = search_title_weight if field == "title" else 1.0
+            avg_length = self.avg_length[field] or 1.0
+            lengths = self.lengths[field]
+            if fuzzy:
+                expanded_terms = self.fuzzy_expand_term(field, term)
+            else:
+                expanded_terms = [(x, 1.0) for x in
+                                  self.expand_term(field, term)]
+            for expanded, similarity in expanded_terms:
+                for number, tf in self.postings[field][expanded].items():
+                    norm = 1 - bm25_b + bm25_b * lengths[number] / avg_length
+                    weighted_tfs[number] = weighted_tfs.get(number, 0) + \
+                        similarity * weight * tf / norm
+        doc_count = len(self.titles)
+        idf = math.log(1 + (doc_count - len(weighted_tfs) + 0.5) /
+                       (len(weighted_tfs) + 0.5))
+        return dict((number, idf * tf / (bm25_k1 + tf))
+                    for number, tf in weighted_tfs.items())
+
+
+class MemoryStore(object):
+    """Texts held in memory, keyed by comic number."""
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.lower = lowercase_values(texts)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def get(self, number):
+        return self.texts.get(number, "")
+
+    def contains(self, number, phrase):
+        return phrase in self.lower.get(number, "")
+
+    def items_lower(self):
+        return self.lower.items()
+
+    def find_regex(self, pattern):
+        """Return the numbers of all texts matching the compiled regex
+        `pattern`."""
+        return [number for number, text in self.texts.items()
+                if pattern.search(text)]
+
+    def add(self, items, source=None):
+        for number, text in items:
+            self.texts[number] = text
+            self.lower[number] = text.lower()
+
+    def close(self):
+        pass
+
+
+class MappedStore(object):
+    """Texts in a memory-mapped file, keyed by comic number.
+
+    `path`.dat holds every text twice, lowercased and as is, both encoded as
+    UTF-8. `path`.idx has a header (with the mtime and size of the file the
+    store was built from) and a table of (comic number, offset, lowercased
+    length, length) sorted by comic number. Phrases are matched against the
+    raw bytes; a text is only decoded when it's returned or searched with a
+    regex.
+    """
+
+    header = struct.Struct("<8sdQ")
+    entry = struct.Struct("<IQII")
+    magic = b"xkcdtxt1"
+
+    def __init__(self, path):
+        self.path = path
+        self.open()
+
+    def open(self):
+        self.data_file = open(self.path + ".dat", 'rb')
+        self.index_file = open(self.path + ".idx", 'rb')
+        self.data = map_file(self.data_file)
+        self.index = map_file(self.index_file)
+        magic, mtime, size = self.header.unpack_from(self.index, 0)
+        if magic != self.magic:
+            self.close()
+            raise ValueError("%s.idx is not a transcript store" % self.path)
+        self.source = (mtime, size)
+        self.count = (len(self.index) - self.header.size) // self.entry.size
+
+    def __len__(self):
+        return self.count
+
+    def entry_at(self, position):
+        return self.entry.unpack_from(
+            self.index, self.header.size + position * self.entry.size)
+
+    def find_entry(self, number):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry_at(middle)[0] < number:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count:
+            entry = self.entry_at(low)
+            if entry[0] == number:
+                return entry
+        return None
+
+    def get(self, number):
+        entry = self.find_entry(number)
+        if entry is None:
+            return ""
+        _, offset, lower_length, length = entry
+        start = offset + lower_length
+        return self.data[start:start + length].decode('utf-8')
+
+    def contains(self, number, phrase):
+        entry = self.find_entry(number)
+        if entry is None:
+            return False
+        _, offset, lower_length, _ = entry
+        return self.data.find(phrase.encode('utf-8'), offset,
+                              offset + lower_length) != -1
+
+    def find_regex(self, pattern):
+        """Return the numbers of all texts matching the compiled regex
+        `pattern`. Each text is decoded first, so it matches exactly like in
+        a MemoryStore."""
+        matches = []
+        for position in range(self.count):
+            number, offset, lower_length, length = self.entry_at(position)
+            start = offset + lower_length
+            text = self.data[start:start + length].decode('utf-8')
+            if pattern.search(text):
+                matches.append(number)
+        return matches
+
+    def items_lower(self):
+        for position in range(self.count):
+            number, offset, lower_length, _ = self.entry_at(position)
+            yield number, \
+                self.data[offset:offset + lower_length].decode('utf-8')
+
+    def add(self, items, source=None):
+        """Add texts without rebuilding the store.
+
+        They are appended to `path`.dat, then a new `path`.idx is written and
+        both are mapped again. `source` is the (mtime, size) of the file the
+        store matches afterwards.
+        """
+        new_entries = []
+        with open(self.path + ".dat", 'ab') as data_file:
+            data_file.seek(0, os.SEEK_END)
+            offset = data_file.tell()
+            for number, text in items:
+                lower = text.lower().encode('utf-8')
+                text = text.encode('utf-8')
+                data_file.write(lower + text)
+                new_entries.append((number, offset, len(lower), len(text)))
+                offset += len(lower) + len(text)
+        new_entries.sort()
+        last = self.entry_at(self.count - 1)[0] if self.count else -1
+        table = self.index[self.header.size:]
+        if new_entries and new_entries[0][0] <= last:  # Not just appended
+            entries = dict((x[0], x) for x in
+                           (self.entry_at(y) for y in range(self.count)))
+            entries.update((x[0], x) for x in new_entries)
+            table = b"".join(self.entry.pack(*entries[x])
+                             for x in sorted(entries))
+        else:
+            table += b"".join(self.entry.pack(*x) for x in new_entries)
+        source = source or self.source
+        write_file_atomic(self.path + ".idx", self.header.pack(
+            self.magic, source[0], source[1]) + table)
+        self.close()
+        self.open()
+
+    def close(self):
+        for mapped in (self.data, self.index):
+            if hasattr(mapped, "close"):
+                mapped.close()
+        self.data_file.close()
+        self.index_file.close()
+
+
+def map_file(file_obj):
+    if os.fstat(file_obj.fileno()).st_size == 0:
+        return b""  # Empty files can't be mapped
+    return mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def build_mapped_store(source, path):
+    """Create a MappedStore at `path` from a titles / transcripts file."""
+    stat = os.stat(source)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    entries = {}
+    fd, tmp_data = tempfile.mkstemp(dir=directory, prefix=".tmp")
+    with os.fdopen(fd, 'wb') as data_file:
+        offset = 0
+        for number, text in iter_metadata_file(source):
+            lower = text.lower().encode('utf-8')
+            text = text.encode('utf-8')
+            data_file.write(lower + text)
+            entries[number] = (number, offset, len(lower), len(text))
+            offset += len(lower) + len(text)
+    index = [MappedStore.header.pack(MappedStore.magic, stat.st_mtime,
+                                     stat.st_size)]
+    index += [MappedStore.entry.pack(*entries[x]) for x in sorted(entries)]
+    fd, tmp_index = tempfile.mkstemp(dir=directory, prefix=".tmp")
+    with os.fdopen(fd, 'wb') as index_file:
+        index_file.write(b"".join(index))
+    replace_file(tmp_data, path + ".dat")
+    replace_file(tmp_index, path + ".idx")
+
+
+def transcript_store_path(source):
+    """Where the MappedStore of the file `source` is cached. The name has a
+    hash of the full path, so different files never share a store."""
+    source = os.path.abspath(source)
+    if isinstance(source, type(u"")):
+        source = source.encode('utf-8', 'replace')
+    return os.path.join(cache_location, "transcripts-%s" %
+                        hashlib.sha1(source).hexdigest()[:16])
+
+
+def open_transcript_store():
+    """Open the MappedStore of transcripts_location, (re)building it in the
+    cache if needed. Falls back to a MemoryStore if that's not possible."""
+    if not os.path.exists(transcripts_location):
+        return MemoryStore({})
+    stat = os.stat(transcripts_location)
+    path = transcript_store_path(transcripts_location)
+    try:
+        store = MappedStore(path)
+        if store.source == (stat.st_mtime, stat.st_size):
+            return store
+        store.close()
+    except (IOError, OSError, ValueError, struct.error):
+        pass
+    try:
+        build_mapped_store(transcripts_location, path)
+        return MappedStore(path)
+    except (IOError, OSError, ValueError, struct.error):
+        return MemoryStore(read_metadata_file(transcripts_location))
 
 
-def get_offline_metadata():
-    with open(titles_location) as titles:
-        titles_str = titles.read()
-    with open(transcripts_location) as transcripts:
-        transcripts_str = transcripts.read()
-    titles_list = titles_str.split("\n")
-    transcripts_list = transcripts_str.split("\n")
-    return titles_list, transcripts_list
+search_index = None
+search_index_lock = threading.RLock()  # Held while searching or updating it
+search_db_updates = 0  # Running updates, which merge into the search index
+word_regex = re.compile(r"\w+", re.UNICODE)
+query_regex = re.compile(r'"([^"]*)"|(\S+)')
 
 
-def match_query(query, title):
+def get_file_stamp(path):
     try:
-        if query.lower() in eval(":".join(title.split(":")[1:])).lower():
-            return True
-        else:
-            return False
-    except SyntaxError:
-        return False
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path, stat.st_mtime, stat.st_size
+
+
+def lowercase_values(metadata):
+    return dict((number, text.lower()) for number, text in metadata.items())
+
+
+def tokenize(text):
+    return word_regex.findall(text.lower())
+
+
+def build_postings(texts):
+    postings = {}
+    lengths = {}
+    for number, text in texts:
+        tokens = tokenize(text)
+        lengths[number] = len(tokens)
+        for token in tokens:
+            posting = postings.setdefault(token, {})
+            posting[number] = posting.get(number, 0) + 1
+    return postings, lengths
+
+
+def get_trigrams(term):
+    padded = "$%s$" % term
+    return set(padded[x:x + 3] for x in range(len(padded) - 2))
+
+
+def add_trigrams(trigrams, term):
+    """Add `term` to a trigram -> {term length: [terms]} index."""
+    for trigram in get_trigrams(term):
+        trigrams.setdefault(trigram, {}).setdefault(
+            len(term), []).append(term)
+
+
+def build_trigrams(terms):
+    trigrams = {}
+    for term in terms:
+        add_trigrams(trigrams, term)
+    return trigrams
+
+
+def fuzzy_max_distance(term):
+    if len(term) <= 3:
+        return 0
+    elif len(term) <= 5:
+        return 1
+    return 2
+
+
+def bag_distance(first, second):
+    """A cheap lower bound of the edit distance: how many characters one
+    string has that the other one lacks."""
+    counts = {}
+    for char in first:
+        counts[char] = counts.get(char, 0) + 1
+    for char in second:
+        counts[char] = counts.get(char, 0) - 1
+    return max(sum(x for x in counts.values() if x > 0),
+               -sum(x for x in counts.values() if x < 0))
+
+
+def edit_distance(first, second, limit):
+    """Levenshtein distance of two strings, or limit + 1 if it's over limit."""
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    previous = list(range(len(second) + 1))
+    for x, first_char in enumerate(first, 1):
+        current = [x]
+        for y, second_char in enumerate(second, 1):
+            current.append(min(previous[y] + 1, current[y - 1] + 1,
+                               previous[y - 1] + (first_char != second_char)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+
+def parse_query(query):
+    """Split a query into OR-separated groups of AND-ed terms.
+
+    Quoted parts are phrases: their words are looked up in the index and the
+    phrase itself must appear verbatim in the matched text.
+    """
+    groups = [([], [])]
+    for phrase, word in query_regex.findall(query):
+        if word == "OR":
+            groups.append(([], []))
+            continue
+        terms, phrases = groups[-1]
+        if phrase:
+            phrases.append(phrase.lower())
+        terms.extend(tokenize(phrase or word))
+    return [group for group in groups if group[0]]
+
+
+def decode_metadata_line(line):
+    number, _, value = line.rstrip("\n").partition(":")
+    if sys.version_info[0] < 3 and value[:1] in ("'", '"'):
+        value = "u" + value  # Read \x escapes as characters, like Python 3
+    value = ast.literal_eval(value)
+    if not isinstance(value, (type(""), type(u""))):
+        raise ValueError("Not a string: %r" % value)
+    return int(number), value
+
+
+def iter_metadata_file(path):
+    with io.open(path, encoding='utf-8') as metadata_file:
+        for line in metadata_file:
+            try:
+                yield decode_metadata_line(line)
+            except (SyntaxError, ValueError):
+                continue
 
 
-def search_titles(titles_list, query):
-    matches = []
-    for x in titles_list:
-        if match_query(query, x):
-            matches.append(x)
-    return matches
+def read_metadata_file(path):
+    if not os.path.exists(path):
+        return {}
+    return dict(iter_metadata_file(path))
 
 
-def search_transcripts(transcripts_list, query, titles_list):
+def get_offline_metadata():
+    global search_index
+    with search_index_lock:
+        db = get_archive()
+        if db is not None:
+            stamp = (get_file_stamp(archive_location),)
+        else:
+            stamp = (get_file_stamp(titles_location),
+                     get_file_stamp(transcripts_location))
+        # An update changes the files as it goes and merges what it
+        # downloaded when it's done, so keep using the index until then.
+        if search_index is None or (search_index.stamp != stamp and
+                                    not search_db_updates):
+            if search_index is not None:
+                search_index.close()
+            if db is not None:
+                titles, transcripts = read_archive(db)
+                transcripts = MemoryStore(transcripts)
+            else:
+                titles = read_metadata_file(titles_location)
+                transcripts = open_transcript_store()
+            search_index = SearchIndex(titles, transcripts, stamp)
+        return search_index
+
+
+def search_comics(index, query, fields, fuzzy=False):
+    """Rank comics matching `query` in `fields`, best match first. With
+    `fuzzy`, words also match indexed words with small typos."""
+    scores = {}
+    for terms, phrases in parse_query(query):
+        group_scores = None
+        for term in terms:
+            term_scores = index.term_scores(term, fields, fuzzy)
+            if group_scores is None:
+                group_scores = term_scores
+                continue
+            group_scores = dict((number, score + term_scores[number])
+                                for number, score in group_scores.items()
+                                if number in term_scores)
+        for number, score in group_scores.items():
+            if number not in index.titles:
+                continue
+            if phrases and not any(
+                    all(index.fields[field].contains(number, phrase)
+                        for phrase in phrases) for field in fields):
+                continue
+            scores[number] = max(scores.get(number, 0), score)
+    ranked = sorted(scores, key=lambda number: (-scores[number], number))
+    return [(number, index.titles[number]) for number in ranked]
+
+
+def search_comics_regex(index, pattern, fields):
+    """Comics where `pattern` matches any of `fields`, title matches first."""
+    pattern = re.compile(pattern, re.IGNORECASE | re.UNICODE)
     matches = []
-    for x in transcripts_list:
-        if match_query(query, x):
-            matches.append(titles_list[transcripts_list.index(x)])
+    for field in fields:
+        for number in sorted(index.fields[field].find_regex(pattern)):
+            if number in index.titles:
+                matches.append((number, index.titles[number]))
     return matches
 
 
-def parse_input(inp):
+archive_schema = """
+CREATE TABLE IF NOT EXISTS comics (
+    num INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    transcript TEXT NOT NULL,
+    alt TEXT,
+    info TEXT  -- The comic's info.0.json, if it has been downloaded
+);
+"""
+
+archive_fts_schema = """
+CREATE VIRTUAL TABLE IF NOT EXISTS comics_fts USING fts5(
+    title, transcript, alt, content='comics', content_rowid='num');
+CREATE TRIGGER IF NOT EXISTS comics_insert AFTER INSERT ON comics BEGIN
+    INSERT INTO comics_fts(rowid, title, transcript, alt)
+        VALUES (new.num, new.title, new.transcript, new.alt);
+END;
+CREATE TRIGGER IF NOT EXISTS comics_delete AFTER DELETE ON comics BEGIN
+    INSERT INTO comics_fts(comics_fts, rowid, title, transcript, alt)
+        VALUES ('delete', old.num, old.title, old.transcript, old.alt);
+END;
+"""
+
+archive_local = threading.local()
+
+
+def get_archive():
+    """Return this thread's connection to the SQLite archive, or None if
+    there is no archive."""
+    if sqlite3 is None or not os.path.exists(archive_location):
+        return None
+    if getattr(archive_local, "location", None) != archive_location:
+        archive_local.db = sqlite3.connect(archive_location)
+        archive_local.location = archive_location
+    return archive_local.db
+
+
+def create_archive(path):
+    db = sqlite3.connect(path)
+    db.executescript(archive_schema)
+    try:
+        db.executescript(archive_fts_schema)
+    except sqlite3.OperationalError:
+        pass  # No FTS5 in this SQLite, search will use a SearchIndex instead
+    return db
+
+
+def archive_has_fts(db):
+    return db.execute("SELECT 1 FROM sqlite_master WHERE name = "
+                      "'comics_fts'").fetchone() is not None
+
+
+def store_archive_comic(db, number, comic_title, transcript, alt=None,
+                        info=None):
+    db.execute("DELETE FROM comics WHERE num = ?", (number,))
+    db.execute("INSERT INTO comics VALUES (?, ?, ?, ?, ?)",
+               (number, comic_title, transcript, alt, info))
+
+
+def read_archive(db):
+    titles = {}
+    transcripts = {}
+    for number, comic_title, transcript in db.execute(
+            "SELECT num, title, transcript FROM comics"):
+        titles[number] = comic_title
+        transcripts[number] = transcript
+    return titles, transcripts
+
+
+def get_archived_metadata(comic):
+    """Return a comic's info.0.json from the archive, or None."""
+    db = get_archive()
+    if db is None:
+        return None
+    row = db.execute("SELECT info FROM comics WHERE num = ?",
+                     (int(comic),)).fetchone()
+    if row is None or row[0] is None:
+        return None
+    return row[0].encode('utf-8')
+
+
+def get_archived_metadata_row(db, number):
+    return db.execute("SELECT 1 FROM comics WHERE num = ? AND info IS NOT "
+                      "NULL", (number,)).fetchone() is not None
+
+
+def import_archive(zip_path, db):
+    """Import titles.txt and transcripts.txt from a search.zip file."""
+    with zipfile.ZipFile(zip_path) as search_zip:
+        metadata = []
+        for name in ("titles.txt", "transcripts.txt"):
+            lines = search_zip.read(name).decode('utf-8').split("\n")
+            metadata.append(dict(decode_metadata_line(x) for x in lines if x))
+    titles, transcripts = metadata
+    with db:
+        for number, comic_title in titles.items():
+            if get_archived_metadata_row(db, number):
+                continue  # Don't replace full records with search.zip data
+            store_archive_comic(db, number, comic_title,
+                                transcripts.get(number, ""))
+    return len(titles)
+
+
+def fts_query(query, fields):
+    groups = []
+    for terms, phrases in parse_query(query):
+        parts = ['"%s"*' % term for term in terms]
+        parts += ['"%s"' % phrase.replace('"', '""') for phrase in phrases]
+        groups.append("(%s)" % " AND ".join(parts))
+    return "{%s} : (%s)" % (" ".join(fields), " OR ".join(groups))
+
+
+def search_archive(db, query, fields):
+    """Rank comics matching `query` in `fields` using the archive's FTS5
+    index, best match first."""
+    if not parse_query(query):
+        return []
+    weights = ", ".join("%f" % (search_title_weight if x == "title" else 1.0)
+                        for x in ("title", "transcript", "alt"))
+    return db.execute(
+        "SELECT comics.num, comics.title FROM comics_fts JOIN comics ON "
+        "comics.num = comics_fts.rowid WHERE comics_fts MATCH ? "
+        "ORDER BY bm25(comics_fts, %s), comics.num" % weights,
+        (fts_query(query, fields),)).fetchall()
+
+
+def find_comics(query, fields, mode="words"):
+    db = get_archive()
+    if mode == "words" and db is not None and archive_has_fts(db):
+        return search_archive(db, query, fields)
+    fields = tuple(x for x in fields if x != "alt")
+    with search_index_lock:  # A background update may merge into the index
+        if mode == "regex":
+            return search_comics_regex(get_offline_metadata(), query, fields)
+        return search_comics(get_offline_metadata(), query, fields,
+                             fuzzy=mode == "fuzzy")
+
+
+def has_search_db(needs_transcripts=True):
+    if get_archive() is not None:
+        return True
+    return os.path.exists(titles_location) and \
+        (os.path.exists(transcripts_location) or not needs_transcripts)
+
+
+class JobCancelled(Exception):
+    def __init__(self):
+        Exception.__init__(self, "cancelled")
+
+
+class Job(object):
+    """A command running in a background thread, started with a trailing `&'.
+
+    Cancelling is cooperative: long loops call check_cancelled(), which
+    raises JobCancelled in the job's thread.
+    """
+
+    def __init__(self, number, command):
+        self.number = number
+        self.command = command
+        self.output = None  # Set when the command is done
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
+        job_local.job = self
+        self.output = parse_input(self.command)
+
+    def status(self):
+        if self.output is not None:
+            return "Done"
+        if self.cancelled.is_set():
+            return "Cancelling"
+        return "Running"
+
+
+jobs = {}
+job_local = threading.local()
+# Jobs and the startup refresh run in other threads; changes of sel_comic and
+# cur_max_comic that depend on their current values hold this lock.
+comic_lock = threading.RLock()
+
+
+def current_job():
+    """The Job running in this thread, or None in the main thread."""
+    return getattr(job_local, "job", None)
+
+
+def check_cancelled():
+    job = current_job()
+    if job is not None and job.cancelled.is_set():
+        raise JobCancelled()
+
+
+def start_job(command):
+    number = max(jobs) + 1 if jobs else 1
+    job = Job(number, command)
+    jobs[number] = job
+    job.thread.start()
+    return "[%s] %s" % (number, command)
+
+
+def finished_jobs():
+    """Return the output of jobs that finished since the last call."""
     output = ""
-    cmds = inp.split(";")
-    for cmd in cmds:
+    for number in sorted(jobs):
+        job = jobs[number]
+        if job.output is not None:
+            del jobs[number]
+            output += "[%s] Done: %s\n%s" % (number, job.command, job.output)
+    return output
+
+
+def wait_for_jobs():
+    for job in list(jobs.values()):
+        job.thread.join()
+    return finished_jobs()
+
+
+def run_commands(inp):
+    """Run the `;'-separated commands in `inp`, yielding each one's output as
+    soon as it's done. A command ending in `&' is started in the background
+    instead."""
+    for cmd in inp.split(";"):
         cmd = cmd.strip()
+        if cmd.endswith("&"):
+            cmd = cmd[:-1].strip()
+            if cmd:
+                yield start_job(cmd) + "\n"
+            continue
         args = cmd.split(" ")
         cmd = args.pop(0)
         if cmd in commands:
             try:
-                output += commands[cmd](*args) + "\n"
+                yield commands[cmd](*args) + "\n"
             except Exception as err:
-                output += str(err)
+                yield str(err)
         elif len(cmd) == 0:
             pass
         else:
-            output += "Unknown command\n"
+            yield "Unknown command\n"
+
+
+def parse_input(inp):
+    output = "".join(run_commands(inp))
     if output == "\n":
         return ""
     return output
 
 
+def write_outputs(outputs):
+    """Write command outputs as they are produced. Like parse_input(), a
+    single empty line of output isn't written."""
+    held = ""
+    for number, output in enumerate(outputs):
+        if number == 0 and output == "\n":
+            held = output
+            continue
+        sys.stdout.write(held + output)
+        sys.stdout.flush()
+        held = ""
+
+
+def run_batch(lines):
+    """Run commands non-interactively, one line at a time, writing out each
+    command's output as it completes. Blank lines and lines starting with
+    `#' are skipped."""
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        for output in run_commands(line):
+            if output != "\n":
+                sys.stdout.write(output)
+                sys.stdout.flush()
+            if not isrunning:
+                return
+    output = wait_for_jobs()
+    if output:
+        sys.stdout.write(output)
+
+
 def get_printable_data(api_data):
     try:
         data = json.loads(api_data.decode('utf-8'))
@@ -209,14 +1489,201 @@ def get_printable_data(api_data):
     return output
 
 
-def display_img(comic):
-    create_tmpfile_if_not_exist(comic)
-    os.system(display_cmd % (tmpimg_location + "%s.png" % comic))
+display_processes = []
+viewer_process = None
+
+
+def display_with_command(comic, path):
+    """Start display_cmd without waiting for its window to be closed."""
+    display_processes[:] = [x for x in display_processes if x.poll() is None]
+    display_processes.append(Popen(display_cmd % path, shell=True))
+    return ""
+
+
+def display_in_viewer(comic, path):
+    """Show the image in a single long-lived viewer, which is started once
+    and reloads cache_location/viewer.png when it's replaced."""
+    global viewer_process
+    shown = os.path.join(cache_location, "viewer.png")
+    make_dirs(cache_location)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_location, prefix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            with open(path, 'rb') as source:
+                shutil.copyfileobj(source, tmp_file)
+        replace_file(tmp_path, shown)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    if viewer_process is None or viewer_process.poll() is not None:
+        viewer_process = Popen(viewer_cmd % shown, shell=True)
     return ""
 
 
+def terminal_width():
+    try:
+        return shutil.get_terminal_size().columns
+    except AttributeError:  # Python 2
+        return int(os.getenv("COLUMNS", "80"))
+
+
+def flatten_image(image):
+    """Convert an image to RGB, with transparent parts shown as white."""
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    return image.convert("RGB")
+
+
+def render_ansi(path, width):
+    """Render an image as rows of half blocks, each character showing two
+    pixels using 24-bit colour escapes."""
+    image = flatten_image(Image.open(path))
+    width = max(1, min(width, image.size[0]))
+    height = max(2, int(image.size[1] * width / float(image.size[0])))
+    height += height % 2
+    image = image.resize((width, height), Image.LANCZOS)
+    pixels = image.load()
+    lines = []
+    for y in range(0, height, 2):
+        line = []
+        previous = None
+        for x in range(width):
+            colours = pixels[x, y] + pixels[x, y + 1]
+            if colours != previous:
+                line.append("\x1b[38;2;%s;%s;%sm\x1b[48;2;%s;%s;%sm" % colours)
+                previous = colours
+            line.append(u"\u2580")
+        lines.append("".join(line) + "\x1b[0m")
+    return "\n".join(lines)
+
+
+def render_cache_dir():
+    return os.path.join(cache_location, "render")
+
+
+def thumbnail_cache_dir():
+    return os.path.join(cache_location, "thumb")
+
+
+image_digests = {}
+
+
+def image_digest(path):
+    """SHA-1 of a file, remembered for as long as the file doesn't change."""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    if key not in image_digests:
+        image_digests[key] = file_sha1(path)
+    return image_digests[key]
+
+
+def get_thumbnail(path, width, height):
+    """Return the path of a copy of an image shrunk to fit in width x height.
+
+    Thumbnails are cached by the source's hash and the size, so each one is
+    only made once, even for identical images of different comics.
+    """
+    name = "%s-%sx%s.png" % (image_digest(path), width, height)
+    thumbnail = os.path.join(thumbnail_cache_dir(), name)
+    if touch_cache_file(thumbnail):
+        return thumbnail
+    image = Image.open(path)
+    if image.mode not in ("L", "RGB", "RGBA"):  # Scale smoothly
+        transparent = "A" in image.mode or "transparency" in image.info
+        image = image.convert("RGBA" if transparent else "RGB")
+    image.thumbnail((width, height), Image.LANCZOS)
+    content = io.BytesIO()
+    image.save(content, "PNG")
+    store_in_cache(thumbnail_cache_dir(), name, content.getvalue(),
+                   image_cache_max_bytes)
+    return thumbnail
+
+
+def display_in_terminal(comic, path):
+    """Draw the image in the terminal. Renders are made from a thumbnail and
+    cached per image and terminal width."""
+    if Image is None:
+        return "Showing images in the terminal needs the Python Imaging " \
+               "Library (pip install pillow)"
+    width = terminal_width()
+    try:
+        name = "%s-%s.ans" % (image_digest(path), width)
+        cached = os.path.join(render_cache_dir(), name)
+        if touch_cache_file(cached):
+            return read_file(cached).decode('utf-8')
+        output = render_ansi(get_thumbnail(path, width, width * 4), width)
+    except (IOError, OSError) as err:
+        return "Can't show image: %s" % err
+    store_in_cache(render_cache_dir(), name, output.encode('utf-8'),
+                   image_cache_max_bytes)
+    return output
+
+
+display_backends = {
+    "command": display_with_command,
+    "viewer": display_in_viewer,
+    "terminal": display_in_terminal
+}
+
+
+def display_img(comic):
+    result = cache_img_if_not_exist(comic, download_progress(comic))
+    if result is True:
+        report_progress("\n")
+    elif result:
+        return result
+    return show_image(comic, image_path(comic))
+
+
+def show_image(comic, path):
+    if display_backend not in display_backends:
+        return "Unknown display backend: %s" % display_backend
+    if display_max_size and Image is not None and \
+            display_backend != "terminal":
+        try:
+            path = get_thumbnail(path, *display_max_size)
+        except (IOError, OSError):
+            pass  # Show the original instead
+    return display_backends[display_backend](comic, path)
+
+
+def gallery_thumbnail(comic):
+    """Path of a comic's gallery thumbnail, or None if it has no image."""
+    try:
+        if cache_img_if_not_exist(comic) not in ("", True):
+            return None
+        return get_thumbnail(image_path(comic), *gallery_thumbnail_size)
+    except (urllib.URLError, socket.error, ValueError, IOError, OSError):
+        return None
+
+
+def make_contact_sheet(thumbnails):
+    """Arrange (comic, thumbnail path) pairs in a grid, labeled with the
+    comic numbers. Returns the sheet as PNG data."""
+    cell_width = gallery_thumbnail_size[0] + 10
+    cell_height = gallery_thumbnail_size[1] + 25
+    columns = min(gallery_columns, len(thumbnails))
+    rows = (len(thumbnails) + columns - 1) // columns
+    sheet = Image.new("RGB", (columns * cell_width, rows * cell_height),
+                      (255, 255, 255))
+    draw = ImageDraw.Draw(sheet)
+    for index, (comic, path) in enumerate(thumbnails):
+        left = index % columns * cell_width
+        top = index // columns * cell_height
+        thumbnail = flatten_image(Image.open(path))
+        sheet.paste(thumbnail, (left + (cell_width - thumbnail.size[0]) // 2,
+                                top + 5))
+        draw.text((left + 5, top + cell_height - 18), "#%s" % comic,
+                  fill=(0, 0, 0))
+    content = io.BytesIO()
+    sheet.save(content, "PNG")
+    return content.getvalue()
+
+
 def display_text(comic):
-    response = get_url(api_url % comic, True)
+    response = get_metadata(comic)
     if response[1] != 200:
         return "Something might've gone wrong (response code: %s)" % \
                response[1]
@@ -225,48 +1692,580 @@ def display_text(comic):
     return print_long_text(output)
 
 
-def random_unique():
+class ExplanationParser(HTMLParser):
+    """Extracts the text of some sections of an explainxkcd page.
+
+    Text is collected while inside one of the h2 sections named in
+    `sections`, with paragraphs wrapped to 79 columns. The page can be fed in
+    pieces as it downloads (use write() for bytes).
+    """
+    void_tags = ("area", "br", "col", "hr", "img", "input", "link", "meta",
+                 "source", "wbr")
+    block_tags = ("p", "div", "table", "ul", "ol", "dl", "pre", "blockquote")
+    skipped_classes = ("mw-editsection", "reference", "noprint", "toc")
+
+    def __init__(self, sections):
+        HTMLParser.__init__(self)
+        self.sections = sections
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.in_section = False
+        self.heading = None  # Heading text, while inside one
+        self.skip_depth = 0
+        self.text = ""
+        self.indent = ""
+        self.lines = []
+
+    def write(self, data):
+        self.feed(self.decoder.decode(data))
+
+    def flush(self, blank_line):
+        text = " ".join(self.text.split())
+        self.text = ""
+        if text:
+            self.lines.extend(textwrap.wrap(
+                text, 79, initial_indent=self.indent,
+                subsequent_indent=" " * len(self.indent)))
+        if blank_line and self.lines and self.lines[-1]:
+            self.lines.append("")
+
+    def handle_starttag(self, tag, attrs):
+        classes = (dict(attrs).get("class") or "").split()
+        if self.skip_depth:
+            if tag not in self.void_tags:
+                self.skip_depth += 1
+        elif tag in ("script", "style") or \
+                any(x in self.skipped_classes for x in classes):
+            if tag not in self.void_tags:
+                self.skip_depth = 1
+        elif tag in ("h2", "h3", "h4"):
+            self.flush(True)
+            self.heading = ""
+        elif not self.in_section:
+            pass
+        elif tag in self.block_tags:
+            self.flush(True)
+        elif tag in ("li", "dd", "dt", "tr", "br"):
+            self.flush(False)
+            self.indent = "  * " if tag == "li" else ""
+        elif tag in ("td", "th"):
+            self.text += " "
+
+    def handle_endtag(self, tag):
+        if self.skip_depth:
+            self.skip_depth -= 1
+        elif self.heading is not None and tag in ("h2", "h3", "h4"):
+            heading = " ".join(self.heading.split())
+            self.heading = None
+            if tag == "h2":
+                self.in_section = heading in self.sections
+            if self.in_section:
+                self.lines.extend([heading, ""])
+        elif not self.in_section:
+            pass
+        elif tag in self.block_tags:
+            self.flush(True)
+        elif tag in ("li", "dd", "dt", "tr"):
+            self.flush(False)
+            self.indent = ""
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        if self.heading is not None:
+            self.heading += data
+        elif self.in_section:
+            self.text += data
+
+    def handle_entityref(self, name):  # Only used by Python 2
+        if name in name2codepoint:
+            self.handle_data(chr(name2codepoint[name]))
+
+    def handle_charref(self, name):  # Only used by Python 2
+        try:
+            if name.lower().startswith("x"):
+                self.handle_data(chr(int(name[1:], 16)))
+            else:
+                self.handle_data(chr(int(name)))
+        except ValueError:
+            pass
+
+    def get_text(self):
+        self.close()
+        self.flush(True)
+        return "\n".join(self.lines).strip("\n") + "\n"
+
+
+def explain_cache_dir():
+    return os.path.join(cache_location, "explain")
+
+
+class RendererNotFound(Exception):
+    def __init__(self):
+        Exception.__init__(self, "HTML renderer not found")
+
+
+def render_explanation(comic):
+    """Download and render a comic's explainxkcd page. Returns (text,
+    response code)."""
+    location = explainxkcd_url % comic
+    if explain_renderer != "external":
+        parser = ExplanationParser(explain_sections)
+        response_code = fetch_url(location, output=parser)[1]
+        return parser.get_text(), response_code
+    content, response_code = get_url(location, True)
+    try:
+        proc = Popen(html_renderer, stdin=PIPE, stdout=PIPE)
+    except OSError:
+        raise RendererNotFound()
+    content = proc.communicate(content)[0]
+    return "".join(content.decode('utf-8').split("[edit] ")[1:-1]), \
+        response_code
+
+
+def get_explanation(comic):
+    """Return (text, response code) of a comic's explanation.
+
+    Explanations are cached for explain_cache_ttl seconds, since the wiki
+    changes. An expired explanation is still used when offline or when
+    explainxkcd can't be reached.
+    """
+    name = "%s-%s.txt" % (comic, explain_renderer)
+    path = os.path.join(explain_cache_dir(), name)
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        age = None
+    if age is not None and (age < explain_cache_ttl or offline):
+        return read_file(path).decode('utf-8'), 200
+    try:
+        text, response_code = render_explanation(comic)
+    except urllib.URLError:
+        if age is None:
+            raise
+        return read_file(path).decode('utf-8'), 200
+    if response_code == 200:
+        store_in_cache(explain_cache_dir(), name, text.encode('utf-8'),
+                       metadata_cache_max_bytes)
+    return text, response_code
+
+
+random_pool = []
+random_pool_max = 0
+random_pool_seen = None
+
+
+def seen_comics_path():
+    return os.path.join(cache_location, "seen.txt")
+
+
+def load_seen_comics():
     global seen_comics
-    avail = list(range(1, cur_max_comic + 1))
-    for x in seen_comics:
-        avail.remove(x)
-    avail.remove(404)
-    output = random.choice(avail)
-    seen_comics.append(sel_comic)
+    try:
+        with open(seen_comics_path()) as seen_file:
+            seen_comics = [int(x) for x in seen_file.read().split()]
+    except (IOError, OSError, ValueError):
+        seen_comics = []
+
+
+def remember_seen_comic(comic):
+    seen_comics.append(comic)
+    try:
+        if not os.path.isdir(cache_location):
+            os.makedirs(cache_location)
+        with open(seen_comics_path(), 'a') as seen_file:
+            seen_file.write("%s\n" % comic)
+    except (IOError, OSError):
+        pass  # Not remembered for the next session, but otherwise fine
+
+
+def forget_seen_comics():
+    del seen_comics[:]
+    if os.path.exists(seen_comics_path()):
+        os.remove(seen_comics_path())
+
+
+def random_unique():
+    """Pick a random comic that hasn't been seen yet.
+
+    Unseen comics are kept in `random_pool`; a draw swaps a random entry to
+    the end of the list and pops it. Once everything has been seen, the seen
+    comics are forgotten and it starts over.
+    """
+    global random_pool, random_pool_max, random_pool_seen
+    if random_pool_seen is not seen_comics or \
+            cur_max_comic < random_pool_max or not random_pool:
+        seen = set(seen_comics)
+        random_pool = [x for x in range(1, cur_max_comic + 1)
+                       if x not in seen and x != 404]
+        if not random_pool:
+            forget_seen_comics()
+            random_pool = [x for x in range(1, cur_max_comic + 1) if x != 404]
+        random_pool_max = cur_max_comic
+        random_pool_seen = seen_comics
+    elif cur_max_comic > random_pool_max:
+        random_pool.extend(x for x in range(random_pool_max + 1,
+                                            cur_max_comic + 1) if x != 404)
+        random_pool_max = cur_max_comic
+    index = random.randrange(len(random_pool))
+    random_pool[index], random_pool[-1] = random_pool[-1], random_pool[index]
+    output = random_pool.pop()
+    remember_seen_comic(output)
+    return output
+
+
+def get_last_committed(path):
+    """Return the number of the last complete line in a search db file.
+
+    A partially written last line (left by an interrupted update) is removed.
+    """
+    with open(path, 'rb+') as db_file:
+        content = db_file.read()
+        end = content.rfind(b"\n") + 1
+        if end < len(content):
+            db_file.truncate(end)
+    lines = content[:end].split(b"\n")
+    for line in reversed(lines):
+        try:
+            return int(line.split(b":")[0])
+        except ValueError:
+            continue
+    return 0
+
+
+def fetch_comic_metadata(comic):
+    return call_with_retries(get_metadata, comic)
+
+
+def update_search_db(only_new=False):
+    global search_db_updates
+    with search_index_lock:
+        search_db_updates += 1
+    try:
+        db = get_archive()
+        if db is not None:
+            return update_archive(db, only_new)
+        return update_search_files()
+    finally:
+        with search_index_lock:
+            search_db_updates -= 1
+
+
+def search_db_writable():
+    """Whether `update search_db' can write to the archive or the title /
+    transcript files."""
+    if get_archive() is not None:
+        paths = [archive_location,  # SQLite also writes a journal next to it
+                 os.path.dirname(os.path.abspath(archive_location))]
+    else:
+        paths = [titles_location, transcripts_location]
+    return all(os.access(x, os.W_OK) for x in paths)
+
+
+def update_archive(db, only_new=False):
+    """Download and archive all comics missing from the archive. With
+    `only_new`, only comics newer than the newest archived one are
+    downloaded, not the full metadata of older ones."""
+    if only_new:
+        newest = db.execute("SELECT MAX(num) FROM comics").fetchone()[0]
+        missing = [x for x in range((newest or 0) + 1, cur_max_comic + 1)
+                   if x != 404]
+        output = "%s comics not in archive found." % len(missing)
+    else:
+        known = set(row[0] for row in db.execute("SELECT num FROM comics "
+                                                 "WHERE info IS NOT NULL"))
+        missing = [x for x in range(1, cur_max_comic + 1)
+                   if x not in known and x != 404]
+        output = "%s comics without full metadata in archive found." % \
+            len(missing)
+    stamp = (get_file_stamp(archive_location),)
+    new_texts = {"title": [], "transcript": []}
+    done = 0
+    try:
+        for _, response in map_concurrently(fetch_comic_metadata, missing,
+                                            update_workers):
+            content, response_code = response
+            if response_code != 200:
+                raise ValueError("response code %s" % response_code)
+            resp_json = json.loads(content.decode('utf-8'))
+            with db:
+                store_archive_comic(db, resp_json['num'], resp_json['title'],
+                                    resp_json['transcript'],
+                                    resp_json['alt'], content.decode('utf-8'))
+            new_texts["title"].append((resp_json['num'], resp_json['title']))
+            new_texts["transcript"].append((resp_json['num'],
+                                            resp_json['transcript']))
+            done += 1
+    except (urllib.URLError, socket.error, ValueError, KeyError,
+            sqlite3.Error, JobCancelled) as err:
+        output += "\nFailed to archive comic %s (%s). Run `update " \
+                  "search_db' again to continue." % (missing[done], err)
+    merge_into_search_index(stamp, new_texts,
+                            (get_file_stamp(archive_location),))
     return output
 
 
-def update_search_db():
-    title_file = open(titles_location, 'r')
-    title_file_contents = title_file.read()
-    title_file.close()
-    last_line = title_file_contents.split("\n")[-2]
-    last_comic = int(last_line.split(":")[0])
+def update_search_files():
+    last_title = get_last_committed(titles_location)
+    last_transcript = get_last_committed(transcripts_location)
+    last_comic = min(last_title, last_transcript)
     output = "%s comics not in title database found." % \
              (cur_max_comic - last_comic)
     if cur_max_comic > last_comic:
+        stamp = (get_file_stamp(titles_location),
+                 get_file_stamp(transcripts_location))
+        new_texts = {"title": [], "transcript": []}
         title_file = open(titles_location, 'a')
         transcripts_file = open(transcripts_location, 'a')
-        for x in range(last_comic + 1, cur_max_comic + 1):
-            response = get_url(api_url % x)
-            resp_json = json.loads(response.decode('utf-8'))
-            title = repr(resp_json['title'])
-            number = resp_json['num']
-            transcript = repr(resp_json['transcript'])
-            title_file.write("%s:%s\n" % (number, title))
-            transcripts_file.write("%s:%s\n" % (number, transcript))
-        title_file.close()
-        transcripts_file.close()
+        comics = range(last_comic + 1, cur_max_comic + 1)
+        committed = last_comic
+        try:
+            for x, response in map_concurrently(fetch_comic_metadata, comics,
+                                                update_workers):
+                content, response_code = response
+                if response_code == 404:
+                    committed = x
+                    continue  # Comic 404 really doesn't exist
+                resp_json = json.loads(content.decode('utf-8'))
+                number = resp_json['num']
+                if number > last_title:
+                    title_file.write("%s:%r\n" % (number, resp_json['title']))
+                    new_texts["title"].append((number, resp_json['title']))
+                if number > last_transcript:
+                    transcripts_file.write("%s:%r\n" %
+                                           (number, resp_json['transcript']))
+                    new_texts["transcript"].append(
+                        (number, resp_json['transcript']))
+                title_file.flush()
+                transcripts_file.flush()
+                committed = x
+        except (urllib.URLError, socket.error, ValueError, KeyError,
+                JobCancelled) as err:
+            output += "\nFailed to download comic %s (%s). Run `update " \
+                      "search_db' again to continue." % (committed + 1, err)
+        finally:
+            title_file.close()
+            transcripts_file.close()
+            new_stamp = (get_file_stamp(titles_location),
+                         get_file_stamp(transcripts_location))
+            merge_into_search_index(stamp, new_texts, new_stamp,
+                                    new_stamp[1] and new_stamp[1][1:])
     return output
 
 
-def create_tmpfile_if_not_exist(comic):
-    if not os.path.exists(tmpimg_location + "%s.png" % comic):
-        return get_img(comic)
+def merge_into_search_index(old_stamp, new_texts, stamp,
+                            transcripts_source=None):
+    """Add newly downloaded comics to the loaded search index.
+
+    If the index didn't match `old_stamp` (the files / archive before the
+    update), it's dropped instead and reloaded by the next search.
+    """
+    global search_index
+    with search_index_lock:
+        if search_index is None:
+            return
+        if search_index.stamp == old_stamp:
+            try:
+                search_index.update(new_texts, stamp, transcripts_source)
+                return
+            except (IOError, OSError, ValueError, struct.error):
+                pass
+        search_index.close()
+        search_index = None
+
+
+def cache_img_if_not_exist(comic, progress=None):
+    mirrored = mirrored_image_path(comic)
+    if mirrored is not None and os.path.exists(mirrored):
+        return ""  # The mirror may be read-only, so leave its mtimes alone
+    path = os.path.join(image_cache_dir(), "%s.png" % comic)
+    if not touch_cache_file(path):
+        return get_img(comic, progress)
     else:
         return ""
 
 
+prefetch_queue = Queue()
+prefetch_generation = 0
+prefetch_thread = None
+
+
+def schedule_prefetch(direction):
+    """Start downloading the next comics in `direction` (1 or -1) in the
+    background, replacing any prefetch still in progress."""
+    global prefetch_generation, prefetch_thread
+    if prefetch_depth <= 0 or offline:
+        return
+    comics = []
+    comic = sel_comic
+    while len(comics) < prefetch_depth:
+        comic += direction
+        if comic == 404:
+            continue
+        if comic < 1 or comic > cur_max_comic:
+            break
+        comics.append(comic)
+    prefetch_generation += 1
+    prefetch_queue.put((prefetch_generation, comics))
+    if prefetch_thread is None:
+        prefetch_thread = threading.Thread(target=prefetch_worker)
+        prefetch_thread.daemon = True
+        prefetch_thread.start()
+
+
+def prefetch_worker():
+    while True:
+        generation, comics = prefetch_queue.get()
+        for comic in comics:
+            if generation != prefetch_generation:
+                break  # The user has moved on, prefetch from there instead
+            try:
+                downloaded = prefetch_comic(comic)
+            except Exception:
+                continue  # Prefetching is best effort
+            if prefetch_max_rate > 0:
+                time.sleep(float(downloaded) / prefetch_max_rate)
+        prefetch_queue.task_done()
+
+
+def prefetch_comic(comic):
+    """Put a comic's metadata (and image) in the cache. Returns the number of
+    bytes downloaded."""
+    downloaded = 0
+    if not os.path.exists(os.path.join(metadata_cache_dir(),
+                                       "%s.json" % comic)):
+        downloaded += len(get_metadata(comic)[0])
+    if prefetch_images and not os.path.exists(image_path(comic)):
+        if get_img(comic) is True:
+            downloaded += os.path.getsize(image_path(comic))
+    return downloaded
+
+
+def mirrored_image_path(comic):
+    """Path of a comic's image in the mirror, or None if it's not there."""
+    try:
+        digest = read_file(os.path.join(mirror_location, "images",
+                                        "%s.sha1" % comic)).decode('ascii')
+    except (IOError, OSError):
+        return None
+    if not digest:
+        return None  # The comic has no image
+    return os.path.join(mirror_location, "objects", digest[:2], digest[2:])
+
+
+def is_mirrored(comic):
+    return os.path.exists(os.path.join(mirror_location, "images",
+                                       "%s.sha1" % comic))
+
+
+def mirror_comic(comic):
+    """Download a comic's metadata and image into the mirror.
+
+    Images are stored by their SHA-1, so identical images are kept once. The
+    images/N.sha1 file is written last and marks the comic as complete.
+    Returns "skipped", "mirrored" or an error message.
+    """
+    if is_mirrored(comic):
+        return "skipped"
+    try:
+        content, response_code = call_with_retries(get_metadata, comic)
+        if response_code != 200:
+            return "comic %s: response code %s" % (comic, response_code)
+        img_source = json.loads(content.decode('utf-8')).get('img')
+        digest = ""
+        if img_source:
+            incoming = os.path.join(mirror_location, "objects",
+                                    "incoming-%s" % comic)
+            response_code = call_with_retries(download_file, img_source,
+                                              incoming)[1]
+            if response_code == 200:
+                digest = file_sha1(incoming)
+                object_path = os.path.join(mirror_location, "objects",
+                                           digest[:2], digest[2:])
+                if os.path.exists(object_path):
+                    os.remove(incoming)
+                else:
+                    make_dirs(os.path.dirname(object_path))
+                    replace_file(incoming, object_path)
+            elif response_code != 404:
+                return "comic %s: image response code %s" % \
+                    (comic, response_code)
+        write_file_atomic(os.path.join(mirror_location, "json",
+                                       "%s.json" % comic), content)
+        write_file_atomic(os.path.join(mirror_location, "images",
+                                       "%s.sha1" % comic), digest.encode())
+    except (urllib.URLError, socket.error, ValueError, IOError,
+            OSError) as err:
+        return "comic %s: %s" % (comic, err)
+    return "mirrored"
+
+
+def report_progress(text):
+    if sys.stdout.isatty() and current_job() is None:
+        sys.stdout.write("\r" + text)
+        sys.stdout.flush()
+
+
+def download_progress(comic):
+    """Progress callback showing how much of a comic's image is downloaded."""
+    def progress(done, total):
+        if total:
+            report_progress("Downloading comic %s: %s%% of %s KiB" %
+                            (comic, done * 100 // total, total // 1024))
+        else:
+            report_progress("Downloading comic %s: %s KiB" %
+                            (comic, done // 1024))
+    return progress
+
+
+export_fields = ["num", "title", "safe_title", "year", "month", "day", "alt",
+                 "img", "transcript", "link", "news"]
+
+
+def export_record(comic):
+    """Metadata of a comic as a dict, or an error message."""
+    try:
+        content, response_code = fetch_comic_metadata(comic)
+    except (urllib.URLError, socket.error) as err:
+        return "comic %s: %s" % (comic, err)
+    if response_code != 200:
+        return "comic %s: response code %s" % (comic, response_code)
+    try:
+        return json.loads(content.decode('utf-8'))
+    except ValueError:
+        return "comic %s: invalid JSON" % comic
+
+
+def format_jsonl(record):
+    return u"%s\n" % json.dumps(record, sort_keys=True)  # Unicode on Python 2
+
+
+def format_csv(values):
+    if sys.version_info[0] < 3:  # Python 2's csv doesn't handle unicode
+        values = [x.encode('utf-8') if isinstance(x, type(u"")) else x
+                  for x in values]
+    row = StringIO()
+    csv.writer(row, lineterminator="\n").writerow(values)
+    line = row.getvalue()
+    return line if isinstance(line, type(u"")) else line.decode('utf-8')
+
+
+def export_lines(comics, file_format, errors):
+    """Yield the lines of an export of `comics`, fetching them lazily.
+
+    Comics not available locally are downloaded concurrently. Comics that
+    can't be loaded are skipped and their error appended to `errors`.
+    """
+    if file_format == "csv":
+        yield format_csv(export_fields)
+    for _, record in map_concurrently(export_record, comics, update_workers):
+        if not isinstance(record, dict):
+            errors.append(record)
+        elif file_format == "csv":
+            yield format_csv([record.get(x, "") for x in export_fields])
+        else:
+            yield format_jsonl(record)
+
+
 def get_amount_from_args(arguments):
     if len(arguments) == 0:
         amount = 1
@@ -278,13 +2277,19 @@ def get_amount_from_args(arguments):
     return amount
 
 
-def parse_matches(matches):
-    matches = list(set(matches))
-    output = "Matches:\n"
+def iter_matches(matches):
+    """Yield the lines of a list of matches, skipping duplicates."""
+    yield "Matches:\n"
+    seen = set()
     for x in matches:
-        result = (x.split(":")[0], eval(":".join(x.split(":")[1:])))
-        output += "(#%s) %s\n" % result
-    return output
+        if x in seen:
+            continue
+        seen.add(x)
+        yield "(#%s) %s\n" % x
+
+
+def parse_matches(matches):
+    return "".join(iter_matches(matches))
 
 
 #  #############################
@@ -293,10 +2298,11 @@ def parse_matches(matches):
 
 def command_random(*arguments):
     global sel_comic
-    if "-f" in arguments:
-        sel_comic = random.randint(1, cur_max_comic)
-    else:
-        sel_comic = random_unique()
+    with comic_lock:
+        if "-f" in arguments:
+            sel_comic = random.randint(1, cur_max_comic)
+        else:
+            sel_comic = random_unique()
     if "-d" in arguments:
         return command_display()
     if "-i" in arguments:
@@ -319,18 +2325,20 @@ def command_display(*arguments):
 
 
 def command_explain(*arguments):
-    if len(arguments) < 1:
-        comic = sel_comic
+    if len(arguments) > 0:
+        try:
+            comic = int(arguments[0])
+        except ValueError:
+            comic = sel_comic
     else:
-        comic = arguments[0]
-    location = explainxkcd_url % comic
-    content = get_url(location)
+        comic = sel_comic
     try:
-        proc = Popen(html_renderer, stdin=PIPE, stdout=PIPE)
-    except OSError:
-        return "HTML renderer not found"
-    content = proc.communicate(content)[0]
-    content = "".join(content.decode('utf-8').split("[edit] ")[1:-1])
+        content, response_code = get_explanation(comic)
+    except RendererNotFound as err:
+        return str(err)
+    if response_code != 200:
+        return "Something might've gone wrong (response code: %s)" % \
+               response_code
     return print_long_text(content)
 
 
@@ -340,33 +2348,39 @@ def command_save(*arguments):
     else:
         location = " ".join(arguments)
     output = "Saving comic %s to location %s" % (sel_comic, location)
-    tmpfile_out = create_tmpfile_if_not_exist(sel_comic)
-    if tmpfile_out != "No image for comic found (maybe it's interactive?)":
-        shutil.copy(tmpimg_location + "%s.png" % sel_comic, location)
-    else:
-        return tmpfile_out
+    cached_out = cache_img_if_not_exist(sel_comic,
+                                        download_progress(sel_comic))
+    if cached_out is True:
+        report_progress("\n")
+    if cached_out not in ("", True):
+        return cached_out
+    shutil.copy(image_path(sel_comic), location)
     return output
 
 
 def command_next(*arguments):
     global sel_comic
     amount = get_amount_from_args(arguments)
-    sel_comic += amount
-    if sel_comic > cur_max_comic:
-        sel_comic = cur_max_comic
-    elif sel_comic == 404:
-        sel_comic = 405
+    with comic_lock:
+        sel_comic += amount
+        if sel_comic > cur_max_comic:
+            sel_comic = cur_max_comic
+        elif sel_comic == 404:
+            sel_comic = 405
+    schedule_prefetch(1)
     return ""
 
 
 def command_prev(*arguments):
     global sel_comic
     amount = get_amount_from_args(arguments)
-    sel_comic -= amount
-    if sel_comic < 1:
-        sel_comic = 1
-    elif sel_comic == 404:
-        sel_comic = 403
+    with comic_lock:
+        sel_comic -= amount
+        if sel_comic < 1:
+            sel_comic = 1
+        elif sel_comic == 404:
+            sel_comic = 403
+    schedule_prefetch(-1)
     return ""
 
 
@@ -382,45 +2396,161 @@ def command_last(*arguments):
     if len(arguments) > 0:
         return "Command does not take arguments"
     global sel_comic
-    sel_comic = cur_max_comic
+    with comic_lock:
+        sel_comic = cur_max_comic
     return ""
 
 
 def command_goto(*arguments):
     global sel_comic
-    if len(arguments) < 1:
-        comic = cur_max_comic
-    else:
-        try:
-            comic = int(arguments[0])
-        except ValueError:
+    with comic_lock:
+        if len(arguments) < 1:
+            comic = cur_max_comic
+        else:
+            try:
+                comic = int(arguments[0])
+            except ValueError:
+                comic = cur_max_comic
+        if comic < 1:
+            comic = 1
+        elif comic > cur_max_comic:
             comic = cur_max_comic
-    if comic < 1:
-        comic = 1
-    elif comic > cur_max_comic:
-        comic = cur_max_comic
-    sel_comic = comic
+        sel_comic = comic
     return ""
 
 
 def command_update(*arguments):
     global sel_comic, cur_max_comic
     output = ""
-    response = get_url(api_url % "")
+    response = get_metadata("")[0]
     new_max_comic = json.loads(response.decode('utf-8'))['num']
-    if new_max_comic > cur_max_comic:
-        if cur_max_comic + 1 == new_max_comic:
-            output += "1 new comic!\n"
+    with comic_lock:
+        new_comics = new_max_comic > cur_max_comic
+        if new_comics:
+            if cur_max_comic + 1 == new_max_comic:
+                output += "1 new comic!\n"
+            else:
+                output += "%s new comics!\n" % \
+                    (new_max_comic - cur_max_comic)
+            cur_max_comic = new_max_comic
         else:
-            output += "%s new comics!\n" % (new_max_comic - cur_max_comic)
-        cur_max_comic = new_max_comic
-    else:
-        output += "No new comics.\n"
-    if "search_db" in arguments:
-        output += update_search_db()
+            output += "No new comics.\n"
+    automatic = new_comics and update_search_db_with_comics and \
+        has_search_db() and search_db_writable()
+    if "search_db" in arguments or automatic:
+        try:
+            output += update_search_db(only_new="search_db" not in arguments)
+        except (IOError, OSError) as err:
+            output += "Couldn't update the search database: %s" % err
     return output
 
 
+def command_mirror(*arguments):
+    try:
+        first = int(arguments[0]) if len(arguments) > 0 else 1
+        last = int(arguments[1]) if len(arguments) > 1 else cur_max_comic
+    except ValueError:
+        return "Arguments must be comic numbers"
+    comics = [x for x in range(max(first, 1), min(last, cur_max_comic) + 1)
+              if x != 404]
+    counts = {"mirrored": 0, "skipped": 0}
+    errors = []
+    for done, result in enumerate(map_concurrently(mirror_comic, comics,
+                                                   mirror_workers), 1):
+        status = result[1]
+        if status in counts:
+            counts[status] += 1
+        else:
+            errors.append(status)
+        report_progress("Mirroring: %s/%s comics (%s failed)" %
+                        (done, len(comics), len(errors)))
+    report_progress("\n")
+    if last >= cur_max_comic:
+        write_file_atomic(os.path.join(mirror_location, "latest"),
+                          str(cur_max_comic).encode())
+    output = "Mirrored %s comics, %s were already mirrored, %s failed." % \
+        (counts["mirrored"], counts["skipped"], len(errors))
+    if errors:
+        output += "\n" + "\n".join(errors) + "\nRun `mirror' again to " \
+                  "retry."
+    return output
+
+
+def command_export(*arguments):
+    file_format = None
+    numbers = []
+    location = None
+    for argument in arguments:
+        if argument in ("--csv", "--jsonl"):
+            file_format = argument[2:]
+        elif argument.isdigit():
+            numbers.append(int(argument))
+        elif argument:
+            location = argument
+    if len(numbers) > 2:
+        return "Too many comic numbers"
+    first = numbers[0] if numbers else 1
+    last = numbers[1] if len(numbers) > 1 else cur_max_comic
+    if file_format is None:
+        csv_location = location is not None and \
+            location.lower().endswith(".csv")
+        file_format = "csv" if csv_location else "jsonl"
+    comics = [x for x in range(max(first, 1), min(last, cur_max_comic) + 1)
+              if x != 404]
+    errors = []
+    lines = export_lines(comics, file_format, errors)
+    if (location is None or location == "-") and current_job() is not None:
+        # Shown with the job's output when it's done
+        output = "".join(lines)[:-1]  # Every line ends with a newline
+        if errors:
+            output += "\n%s failed:\n%s" % (len(errors), "\n".join(errors))
+        return output
+    if location is None or location == "-":
+        if use_less:
+            print_long_text(lines)
+        else:
+            for line in lines:
+                sys.stdout.write(line)
+            sys.stdout.flush()
+        for error in errors:
+            sys.stderr.write(error + "\n")
+        return ""
+    try:
+        with io.open(location, 'w', encoding='utf-8', newline="") as out:
+            for line in lines:
+                out.write(line)
+    except (IOError, OSError) as err:
+        return str(err)
+    output = "Exported %s comics to %s." % (len(comics) - len(errors),
+                                            location)
+    if errors:
+        output += "\n%s failed:\n%s" % (len(errors), "\n".join(errors))
+    return output
+
+
+def command_gallery(*arguments):
+    if Image is None:
+        return "The gallery needs the Python Imaging Library (pip install " \
+               "pillow)"
+    try:
+        first = int(arguments[0]) if len(arguments) > 0 else \
+            sel_comic - gallery_size + 1
+        last = int(arguments[1]) if len(arguments) > 1 else \
+            first + gallery_size - 1
+    except ValueError:
+        return "Arguments must be comic numbers"
+    comics = [x for x in range(max(first, 1), min(last, cur_max_comic) + 1)
+              if x != 404]
+    thumbnails = [(comic, path) for comic, path in
+                  map_concurrently(gallery_thumbnail, comics, update_workers)
+                  if path is not None]
+    if not thumbnails:
+        return "No images to show"
+    path = os.path.join(cache_location, "gallery.png")
+    write_file_atomic(path, make_contact_sheet(thumbnails))
+    return show_image(None, path)
+
+
 def command_exit(*arguments):
     global isrunning
     if len(arguments) > 0:
@@ -429,6 +2559,34 @@ def command_exit(*arguments):
     return ""
 
 
+def command_jobs(*arguments):
+    if len(arguments) > 0:
+        return "Command does not take arguments"
+    output = finished_jobs()
+    for number in sorted(jobs):
+        output += "[%s] %s: %s\n" % (number, jobs[number].status(),
+                                     jobs[number].command)
+    if not output:
+        return "No jobs"
+    return output.rstrip("\n")
+
+
+def command_cancel(*arguments):
+    if len(arguments) < 1:
+        if not jobs:
+            return "No jobs"
+        number = max(jobs)
+    else:
+        try:
+            number = int(arguments[0].lstrip("%"))
+        except ValueError:
+            return "Argument must be a job number"
+    if number not in jobs:
+        return "No such job"
+    jobs[number].cancelled.set()
+    return "Cancelling [%s] %s" % (number, jobs[number].command)
+
+
 def command_license(*arguments):
     if len(arguments) > 0:
         return "Command does not take arguments"
@@ -471,50 +2629,58 @@ Use `help [command]' to get help."""
             return "Unknown command."
 
 
-def command_search(*arguments):
-    if not os.path.exists(titles_location) or not \
-            os.path.exists(transcripts_location):
+search_modes = {"-r": "regex", "--regex": "regex",
+                "-f": "fuzzy", "--fuzzy": "fuzzy"}
+
+
+def run_search_command(arguments, fields, needs_transcripts=True):
+    if not has_search_db(needs_transcripts):
         return "This function needs a dictionary of comic titles. Please " \
                "see the documentation of the program for more info."
-    elif len(arguments) < 1:
+    arguments = list(arguments)
+    mode = "words"
+    while arguments and arguments[0] in search_modes:
+        mode = search_modes[arguments.pop(0)]
+    if len(arguments) < 1:
         return "Missing argument: query"
-    else:
-        query = " ".join(arguments)
-        titles_list, transcripts_list = get_offline_metadata()
-        matches = []
-        matches += search_titles(titles_list, query)
-        matches += search_transcripts(transcripts_list, query, titles_list)
-        return parse_matches(matches)
+    query = " ".join(arguments)
+    try:
+        matches = find_comics(query, fields, mode)
+    except re.error as err:
+        return "Invalid regular expression: %s" % err
+    return print_long_text(iter_matches(matches))
+
+
+def command_search(*arguments):
+    return run_search_command(arguments, ("title", "transcript", "alt"))
 
 
 def command_search_titles(*arguments):
-    if not os.path.exists(titles_location):
-        return "This function needs a dictionary of comic titles. Please " \
-               "see the documentation of the program for more info."
-    elif len(arguments) < 1:
-        return "Missing argument: query"
-    else:
-        query = " ".join(arguments)
-        titles_list, transcripts_list = get_offline_metadata()
-        matches = []
-        matches += search_titles(titles_list, query)
-        return parse_matches(matches)
+    return run_search_command(arguments, ("title",), needs_transcripts=False)
 
 
 def command_search_transcripts(*arguments):
+    return run_search_command(arguments, ("transcript",))
+
+
+def command_import(*arguments):
+    if sqlite3 is None:
+        return "This function needs Python's sqlite3 module."
+    zip_path = " ".join(arguments) if arguments else "search.zip"
+    if not os.path.exists(zip_path):
+        return "File not found: %s" % zip_path
+    created = not os.path.exists(archive_location)
+    db = create_archive(archive_location)
+    try:
+        count = import_archive(zip_path, db)
+    except (zipfile.BadZipfile, KeyError, SyntaxError, ValueError) as err:
+        db.close()
+        if created:  # An empty archive would hide the search files
+            os.remove(archive_location)
+        return "Could not import %s: %s" % (zip_path, err)
+    db.close()
+    return "Imported %s comics into %s." % (count, archive_location)
 
-    if not os.path.exists(titles_location) or not \
-            os.path.exists(transcripts_location):
-        return "This function needs a dictionary of comic titles. Please " \
-               "see the documentation of the program for more info."
-    elif len(arguments) < 1:
-        return "Missing argument: query"
-    else:
-        query = " ".join(arguments)
-        titles_list, transcripts_list = get_offline_metadata()
-        matches = []
-        matches += search_transcripts(transcripts_list, query, titles_list)
-        return parse_matches(matches)
 
 #  #############################
 #  # Commands index & help     #
@@ -535,8 +2701,14 @@ commands = {
     "search": command_search,
     "search-titles": command_search_titles,
     "search-transcripts": command_search_transcripts,
+    "import": command_import,
+    "mirror": command_mirror,
+    "gallery": command_gallery,
+    "export": command_export,
     "quit": command_exit,
     "exit": command_exit,
+    "jobs": command_jobs,
+    "cancel": command_cancel,
     "license": command_license,
     "help": command_help
 }
@@ -551,28 +2723,63 @@ commands_help = {
                "displays image (using your selected method of displaying "
                "images). When first argument is number, displays comic with "
                "that ID.",
-    "explain": "Opens selected comic's explainxkcd page with your chosen "
-               "browser. If an argument is provided, open that comic's page. "
-               "Great if you missed the point of a comic.",
+    "explain": "Shows the explanation and transcript of the selected comic "
+               "from explainxkcd. If an argument is provided, explains that "
+               "comic instead. Great if you missed the point of a comic. "
+               "Explanations are cached for a day.",
     "next": "Selects next comic. When called with an argument, moves "
-            "[argument] number of comics forward.",
+            "[argument] number of comics forward. The following comics are "
+            "downloaded in the background.",
     "prev": "Selects previous comic. When called with an argument, moves "
-            "[argument] number of comics backward.",
+            "[argument] number of comics backward. The preceding comics are "
+            "downloaded in the background.",
     "first": "Selects the first comic. Takes no arguments.",
     "last": "Selects the last comic. Takes no arguments.",
     "goto": "Moves to comic number [argument]. Without arguments, goes to "
             "last comic.",
-    "update": "Updates latest comic. Takes no arguments.",
+    "update": "Updates latest comic. With update_search_db_with_comics "
+              "set, new comics are also added to the search database (if "
+              "you have one and can write to it). With `search_db' as an "
+              "argument, the search database is always checked for missing "
+              "comics.",
     "save": "Saves selected comic to disk, with file name [arguments]. "
             "Without arguments, saves to `[comic number].png'.",
     "search": "Searches a database of comic titles / transcripts for a "
-              "specified query.",
+              "specified query. Results are ranked by relevance, with title "
+              "matches counting more. All words must match (words match "
+              "by prefix); separate alternatives with `OR'. Put a phrase in "
+              "double quotes to require it verbatim. With -f (--fuzzy), "
+              "words with small typos match too. With -r (--regex), the "
+              "query is a regular expression.",
     "search-titles": "Searches a database of comic titles for a specified "
-                     "query.",
+                     "query. Takes the same options as `search'.",
     "search-transcripts": "Searches a database of comic trascripts for a "
-                          "specified query.",
+                          "specified query. Takes the same options as "
+                          "`search'.",
+    "import": "Creates the SQLite archive (archive_location) from a "
+              "search.zip file, by default `search.zip' in the current "
+              "directory. When the archive exists, it is used for search, "
+              "display and `update search_db' instead of the title / "
+              "transcript files.",
+    "gallery": "Shows a contact sheet of the comics up to the selected one, "
+               "or of comics [argument 1] to [argument 2]. Needs PIL.",
+    "mirror": "Downloads the metadata and images of all comics (or comics "
+              "[argument 1] to [argument 2]) to mirror_location, so they "
+              "can be displayed without network access. Comics already "
+              "mirrored are skipped, so an interrupted mirror can be "
+              "resumed by running it again.",
+    "export": "Writes the metadata of all comics (or comics [argument 1] to "
+              "[argument 2]) to a file, or to the screen if no file is "
+              "given. The format is JSON Lines, or CSV with --csv or a file "
+              "name ending in .csv. Cached comics are used, the rest are "
+              "downloaded.",
     "quit": "Closes the program. Takes no arguments.",
     "help": "Shows help. With an argument, shows help for command [argument].",
+    "jobs": "Lists the commands running in the background. End a command "
+            "with `&' to run it in the background; its output is shown once "
+            "it's done.",
+    "cancel": "Stops background job [argument] (by default the latest one). "
+              "The job stops at its next download.",
     "license": "Shows license."
 }
 
@@ -591,26 +2798,111 @@ def main():
     print("Type `help' or `license' for more info")
 
     while isrunning:
+        sys.stdout.write(finished_jobs())
         try:
             sys.stdout.write("\x1b]2;"+(title % sel_comic)+"\x07")
             inp = input(prompt % sel_comic)
         except (KeyboardInterrupt, EOFError):
             print()
             break
-        sys.stdout.write(parse_input(inp))
+        write_outputs(run_commands(inp))
+
+
+def get_cached_max_comic():
+    """Latest comic number known without using the network, or None."""
+    try:
+        path = os.path.join(metadata_cache_dir(), "latest.json")
+        return json.loads(read_file(path).decode('utf-8'))['num']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    try:
+        return int(read_file(os.path.join(mirror_location, "latest")))
+    except (IOError, OSError, ValueError):
+        pass
+    db = get_archive()
+    if db is not None:
+        return db.execute("SELECT MAX(num) FROM comics").fetchone()[0]
+    known_comics = read_metadata_file(titles_location)
+    return max(known_comics) if known_comics else None
+
+
+def refresh_max_comic():
+    global cur_max_comic, sel_comic
+    try:
+        response = get_metadata("")[0]
+        new_max_comic = json.loads(response.decode('utf-8'))['num']
+    except (urllib.URLError, socket.error, ValueError, KeyError):
+        return
+    with comic_lock:
+        if new_max_comic > cur_max_comic:
+            if sel_comic == cur_max_comic:
+                sel_comic = new_max_comic
+            cur_max_comic = new_max_comic
+
+
+def startup(background=True):
+    """Set the latest comic from the cache, refreshing it in the background.
+
+    Only when nothing is cached yet does this wait for the network, unless
+    `background` is false: batch mode refreshes before running commands,
+    so they don't race the refresh."""
+    global cur_max_comic, sel_comic
+    cur_max_comic = get_cached_max_comic()
+    if cur_max_comic is None:
+        try:
+            response = get_metadata("")[0]
+        except urllib.URLError as urllib_error:
+            print(urllib_error)
+            sys.exit(1)
+        cur_max_comic = json.loads(response.decode('utf-8'))['num']
+        sel_comic = cur_max_comic
+    else:
+        sel_comic = cur_max_comic
+        if offline:
+            return
+        if not background:
+            refresh_max_comic()
+            return
+        thread = threading.Thread(target=refresh_max_comic)
+        thread.daemon = True
+        thread.start()
+
+
+def parse_args():
+    """Parse the command line. Returns an iterable of command lines to run
+    in batch mode, or None to run interactively."""
+    global offline, use_less
+    parser = argparse.ArgumentParser(description="A command line xkcd client")
+    parser.add_argument("--offline", action="store_true",
+                        help="don't use the network, only cached data")
+    parser.add_argument("-c", dest="commands", metavar="COMMANDS",
+                        help="run `;'-separated commands and exit")
+    parser.add_argument("-f", dest="script", metavar="FILE",
+                        help="run commands from FILE (- for stdin) and exit")
+    args = parser.parse_args()
+    offline = offline or args.offline
+    if args.commands is not None:
+        batch = [args.commands]
+    elif args.script == "-" or (args.script is None and
+                                not sys.stdin.isatty()):
+        batch = sys.stdin
+    elif args.script is not None:
+        try:
+            batch = open(args.script)
+        except (IOError, OSError) as err:
+            parser.error(str(err))
+    else:
+        return None
+    use_less = False
+    return batch
 
-    if os.path.exists(tmpimg_location):
-        shutil.rmtree(tmpimg_location)
 
 if __name__ == "__main__":
     isrunning = True
-    seen_comics = []
-    try:
-        response_ = urllib.urlopen(api_url % "")
-    except urllib.URLError as urllib_error:
-        print(urllib_error)
-        sys.exit(1)
-    cur_max_comic = json.loads(response_.read().decode())['num']
-    response_.close()
-    sel_comic = cur_max_comic
-    main()
+    batch = parse_args()
+    load_seen_comics()
+    startup(background=batch is None)
+    if batch is None:
+        main()
+    else:
+        run_batch(batch)